@@ -0,0 +1,373 @@
+#!/usr/env/python3
+"""
+
+Offline benchmark of the dehaze algorithm.  No ONC token or network connection
+is needed: synthetic hazy camera array images (a scene seen through water with
+the haze model I = J t + A (1 - t)) are generated and saved as BMP images in a
+tarfile like the ones of the 3D camera array.  `dehaze`, `dehaze_batch` and
+`dehaze_strips` are run on the images in memory and `processTar` on the
+tarfile, each in its own process so its peak memory can be measured.
+
+The report (frames per second, seconds spent in each stage and peak memory of
+every case) is printed as JSON, or written to `report.json` if it is given, so
+runs can be compared across releases.
+
+From the `dehaze` folder:
+    python3 benchmark.py [nimages] [report.json]
+    python3 benchmark.py minfilter [report.json]
+    python3 benchmark.py temporal [nimages] [report.json]
+    python3 benchmark.py guided [report.json]
+
+`minfilter` compares the minimum filter of the dark channel with the one of
+SciPy for window sizes from 3 to 79.  `temporal` dehazes a sequence of images
+of one camera with and without reusing the atmospheric light.  `guided`
+compares the guided filter that refines the transmission with the one of
+opencv-contrib, with OpenCV and NumPy box filters and subsampled.
+"""
+
+import sys
+import os
+import json
+import time
+import shutil
+import tarfile
+import tempfile
+import platform
+import subprocess
+import numpy as np
+
+import utils
+import minfilter
+import guided
+import dehaze_script
+from temporal import Temporal
+from dehaze_script import imageio
+
+"""
+Generate a hazy color image: a textured scene with a few objects whose
+transmission falls with the distance, mixed with a blue-green water light
+"""
+def hazy_image(frame_size=(1024,1280), seed=0):
+    rng = np.random.RandomState(seed)
+    h, w = frame_size
+    y, x = np.mgrid[0:h, 0:w].astype(np.float32)
+
+    #Seafloor texture with some rocks/animals in front
+    scene = 0.3 + 0.2 * rng.rand(h // 16 + 1, w // 16 + 1, 3).repeat(16, 0).repeat(16, 1)[:h,:w]
+    depth = 1. + 4. * y[::-1] / h
+    for _ in range(8):
+        cy, cx, r = rng.randint(0, h), rng.randint(0, w), rng.randint(20, 120)
+        inside = (y - cy) ** 2 + (x - cx) ** 2 < r ** 2
+        scene[inside] = rng.uniform(0.2, 1., 3)
+        depth[inside] = rng.uniform(0.5, 2.)
+
+    t = np.exp(-0.6 * depth)[:,:,np.newaxis]
+    water = np.array([0.15, 0.55, 0.6], dtype=np.float32)
+    hazy = scene * t + water * (1 - t) + rng.normal(0, 0.01, (h, w, 3))
+    return (np.clip(hazy, 0, 1) * 255).astype(np.uint8)
+
+"""
+Consecutive images of a camera: the same hazy scene with some noise, a water
+light that drifts slightly and a small object that moves across
+"""
+def hazy_sequence(nimages, frame_size=(1024,1280), seed=0):
+    rng = np.random.RandomState(seed)
+    h, w = frame_size
+    base = hazy_image(frame_size, seed).astype(np.float32)
+    y, x = np.mgrid[0:h, 0:w]
+    images = []
+    for i in range(nimages):
+        img = base + rng.normal(0, 2., base.shape) + np.array([0, 3., 3.]) * np.sin(i / 5.)
+        cy, cx = h // 2, int(w * (i + 1) / (nimages + 1))
+        img[(y - cy) ** 2 + (x - cx) ** 2 < (h // 20) ** 2] = [200, 180, 120]
+        images.append(np.clip(img, 0, 255).astype(np.uint8))
+    return images
+
+"""
+Write `nimages` hazy BMP images to the tarfile `tar_fn`, in a folder like the
+camera array tarfiles.  Returns the images.
+"""
+def hazy_tar(tar_fn, nimages, frame_size=(1024,1280)):
+    images = [ hazy_image(frame_size, seed) for seed in range(nimages) ]
+    work_dir = tempfile.mkdtemp()
+    source_dir = os.path.splitext(os.path.basename(tar_fn))[0]
+    os.mkdir(os.path.join(work_dir, source_dir))
+    with tarfile.open(tar_fn, "w") as tar:
+        for i, img in enumerate(images):
+            fn = os.path.join(work_dir, source_dir, "image{:04d}.bmp".format(i))
+            imageio.imwrite(fn, img)
+            tar.add(fn, arcname=os.path.join(source_dir, os.path.basename(fn)))
+    shutil.rmtree(work_dir)
+    return images
+
+"""
+The seconds spent in the stages that aren't nested in another one
+"""
+def top_stages():
+    return { name : stage["secs"] for name, stage in utils.stats.report()["stages"].items() 
+             if "/" not in name }
+
+"""
+The most memory (MB) allocated at a time while running `fn(*args)`, NumPy
+arrays included
+"""
+def traced_peak(fn, *args):
+    import tracemalloc
+    tracemalloc.start()
+    try:
+        fn(*args)
+        return tracemalloc.get_traced_memory()[1] / 2. ** 20
+    finally:
+        tracemalloc.stop()
+
+"""
+Dehaze the images in memory and return the images per second and the seconds
+spent in each stage of the algorithm
+"""
+def bench_dehaze(images, opts):
+    utils.stats.reset(enabled=True)
+    start = time.time()
+    for img in images:
+        dehaze_script.dehaze(img, opts)
+    secs = time.time() - start
+    return { "frames" : len(images), "secs" : secs,
+             "fps" : len(images) / secs, "stages" : top_stages(),
+             "image_peak_mb" : traced_peak(dehaze_script.dehaze, images[0], opts) }
+
+"""
+Dehaze the images in stacks of `batch` with `dehaze_batch` and return the
+images per second, the seconds spent in each stage and the largest difference
+with `dehaze`
+"""
+def bench_batch(images, opts, batch=4):
+    utils.stats.reset(enabled=True)
+    start = time.time()
+    processed = []
+    for i in range(0, len(images), batch):
+        processed.extend(dehaze_script.dehaze_batch(np.stack(images[i:i+batch]), opts))
+    secs = time.time() - start
+    stages = top_stages()
+
+    utils.stats.reset(enabled=False)
+    diff = max(np.abs(dehaze_script.dehaze(img, opts).astype(np.int16) - out).max()
+               for img, out in zip(images, processed))
+    return { "frames" : len(images), "secs" : secs, "fps" : len(images) / secs, 
+             "stages" : stages, "batch" : batch, "max_diff" : int(diff) }
+
+"""
+Dehaze the images in strips of `height` rows with `dehaze_strips` and return
+the images per second, the seconds spent in each stage and the largest 
+difference with `dehaze`
+"""
+def bench_strips(images, opts, height=128):
+    utils.stats.reset(enabled=True)
+    start = time.time()
+    processed = [ dehaze_script.dehaze_strips(img, dict(opts, stripHeight=height)) 
+                  for img in images ]
+    secs = time.time() - start
+    stages = top_stages()
+
+    utils.stats.reset(enabled=False)
+    peak = traced_peak(dehaze_script.dehaze_strips, images[0], dict(opts, stripHeight=height))
+    diff = max(np.abs(dehaze_script.dehaze(img, opts).astype(np.int16) - out).max()
+               for img, out in zip(images, processed))
+    return { "frames" : len(images), "secs" : secs, "fps" : len(images) / secs, 
+             "stages" : stages, "strip_height" : height, "max_diff" : int(diff),
+             "image_peak_mb" : peak }
+
+"""
+Dehaze the tarfile like the script does (extracting it, with `stream` or with
+`workers`) and return the images per second and the seconds spent extracting, reading,
+dehazing, writing and packing
+"""
+def bench_tar(tar_fn, nimages, opts):
+    out_dir = tempfile.mkdtemp()
+    start = time.time()
+    new_tar_fn = dehaze_script.processTar(tar_fn, out_dir, dict(opts, stats=1))
+    secs = time.time() - start
+    os.remove(new_tar_fn)
+    shutil.rmtree(out_dir)
+    return { "frames" : nimages, "secs" : secs,
+             "fps" : nimages / secs, "stages" : top_stages() }
+
+"""
+Dehaze a sequence of images of a camera with and without the temporal reuse
+of the atmospheric light (and transmission).  Returns the images per second,
+the number of images that reused an estimate, the flicker (standard deviation
+of the change of mean brightness between consecutive images) and the mean
+difference with the images dehazed without reuse.
+"""
+def bench_temporal(images, opts):
+    results = []
+    reference = None
+    for name, temporal_opts in [ ("fresh", dict(temporal=0)), 
+                                 ("temporal", dict(temporal=1)),
+                                 ("temporal transmission", dict(temporal=1, temporalTransmission=1)) ]:
+        o = dict(opts, **temporal_opts)
+        cache = None
+        if o["temporal"]:
+            cache = Temporal(o["temporalWindow"], o["temporalSmoothing"], o["temporalThreshold"])
+        start = time.time()
+        processed = [ dehaze_script.dehaze(img, o, cache, "") for img in images ]
+        secs = time.time() - start
+
+        brightness = np.array([ img.mean() for img in processed ])
+        if reference is None:
+            reference = processed
+        results.append({ "name" : name, "frames" : len(images), "secs" : secs, 
+                         "fps" : len(images) / secs, 
+                         "reused" : cache.reused if cache is not None else 0,
+                         "flicker" : float(np.diff(brightness).std()),
+                         "mean_diff" : float(np.mean([ np.abs(a.astype(np.int16) - b).mean() 
+                                                       for a, b in zip(processed, reference) ])) })
+    return results
+
+"""
+Time `scipy.ndimage.minimum_filter` and `minfilter.min_filter` on a float32
+and a uint8 image for every window size, and check they give the same result
+"""
+def bench_min_filter(sizes, frame_size=(1024,1280), repeat=3):
+    from scipy.ndimage import minimum_filter
+    rng = np.random.RandomState(0)
+    results = []
+    for dtype in (np.float32, np.uint8):
+        img = (rng.rand(*frame_size) * 255).astype(dtype)
+        for size in sizes:
+            result = { "dtype" : np.dtype(dtype).name, "wsize" : size }
+            for name, fn in [ ("scipy", minimum_filter), ("vhgw", minfilter.min_filter) ]:
+                start = time.time()
+                for _ in range(repeat):
+                    out = fn(img, size)
+                result[name + "_ms"] = (time.time() - start) / repeat * 1000
+                result[name] = out
+            result["same"] = bool(np.array_equal(result.pop("scipy"), result.pop("vhgw")))
+            results.append(result)
+    return results
+
+"""
+Refine the transmission of a hazy image with the guided filter of guided.py
+(with the OpenCV box filters when it is installed and the NumPy ones, at full
+resolution and subsampled) and the one of opencv-contrib if it is installed.
+Returns the milliseconds per call of each and the largest and mean difference
+with the first one.
+"""
+def bench_guided(opts, subsamples=(2, 4), repeat=3):
+    src = hazy_image()
+    img = dehaze_script.preprocess(src, opts["preprocess"])
+    dark = dehaze_script.dark_channel(img, opts["wsize"])
+    at = dehaze_script.atmosphere(img, dark, opts["ratio"])
+    t = dehaze_script.transmission(img, at, opts["omega"], opts["wsize"])
+    gray = dehaze_script.gray(src)
+
+    cases = []
+    if guided.contribGuidedFilter is not None:
+        cases.append(("ximgproc", guided.contribGuidedFilter, 1, True))
+    for s in (1,) + tuple(subsamples):
+        if guided.cv is not None:
+            cases.append(("opencv box", guided._guided_filter, s, True))
+        cases.append(("numpy box", guided._guided_filter, s, False))
+
+    box_cv = guided.cv
+    results, reference = [], None
+    for name, fn, s, use_cv in cases:
+        guided.cv = box_cv if use_cv else None
+        args = (gray, t, 15, 0.85) + ((s,) if fn is guided._guided_filter else ())
+        start = time.time()
+        for _ in range(repeat):
+            out = fn(*args)
+        ms = (time.time() - start) / repeat * 1000
+        reference = out if reference is None else reference
+        diff = np.abs(out - reference)
+        results.append({ "name" : name, "subsample" : s, "ms" : ms,
+                         "max_diff" : float(diff.max()), "mean_diff" : float(diff.mean()) })
+    guided.cv = box_cv
+    return results
+
+"""
+The version of the code and the libraries the report was made with
+"""
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                universal_newlines=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    versions = { "python" : platform.python_version(), "numpy" : np.__version__ }
+    try:
+        import cv2 as cv
+        versions["opencv"] = cv.__version__
+    except ImportError:
+        pass
+    return { "time" : time.strftime("%Y-%m-%dT%H:%M:%S"), "commit" : commit,
+             "machine" : platform.machine(), "cpus" : os.cpu_count(),
+             "versions" : versions }
+
+"""
+Print the report as JSON, or write it to `report_fn`
+"""
+def output(report, report_fn=None):
+    if report_fn:
+        with open(report_fn, "w") as f:
+            json.dump(report, f, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
+
+"""
+The commands of the benchmark, called with the dehaze params and the
+arguments after the command name.  Each returns the report.
+"""
+def run_min_filter(opts, args):
+    sizes = [3, 9, 19, 39, 79]
+    return dict(environment(), benchmark="minfilter", frame_size=[1024,1280],
+                cases=bench_min_filter(sizes)), args[0] if args else None
+
+def run_guided(opts, args):
+    return dict(environment(), benchmark="guided", frame_size=[1024,1280],
+                cases=bench_guided(opts)), args[0] if args else None
+
+def run_temporal(opts, args):
+    nimages = int(args[0]) if args else 30
+    return dict(environment(), benchmark="temporal", opts=opts, 
+                cases=bench_temporal(hazy_sequence(nimages), opts)), \
+           args[1] if len(args) > 1 else None
+
+#Without a command: [nimages] [report.json]
+def run_dehaze(opts, args):
+    nimages = int(args[0]) if args else 8
+    tar_fn = os.path.join(tempfile.mkdtemp(), "synthetic.tar")
+    images = hazy_tar(tar_fn, nimages)
+
+    #At least two workers so the pool is used even on one core
+    workers = max(os.cpu_count(), 2)
+    cases = []
+    for name, fn, fn_args in [ ("dehaze", bench_dehaze, (images, opts)),
+                               ("batch", bench_batch, (images, opts)),
+                               ("strips", bench_strips, (images, opts)),
+                               ("tar", bench_tar, (tar_fn, nimages, dict(opts, stream=0))),
+                               ("stream", bench_tar, (tar_fn, nimages, dict(opts, stream=1))),
+                               ("workers", bench_tar, (tar_fn, nimages, 
+                                                       dict(opts, stream=1, workers=workers))) ]:
+        result, peak = utils.run_isolated(fn, *fn_args)
+        result.update(name=name, peak_mb=peak)
+        cases.append(result)
+    shutil.rmtree(os.path.dirname(tar_fn))
+
+    return dict(environment(), benchmark="dehaze", opts=opts, cases=cases), \
+           args[1] if len(args) > 1 else None
+
+COMMANDS = { "minfilter" : run_min_filter,
+             "guided"    : run_guided,
+             "temporal"  : run_temporal }
+
+def main(argv):
+    with open("params.json", "r") as f:
+        opts = json.load(f)["dehaze"]
+    if len(argv) > 1 and argv[1] in COMMANDS:
+        report, report_fn = COMMANDS[argv[1]](opts, argv[2:])
+    else:
+        report, report_fn = run_dehaze(opts, argv[1:])
+    output(report, report_fn)
+
+if __name__ == "__main__":
+    main(sys.argv)
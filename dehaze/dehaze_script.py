@@ -13,14 +13,26 @@ import utils
 #on the image. This is shown as an example, as imageio is available
 utils.install_and_import("imageio", "imageio")
 from utils import imageio
+from utils import stats
 
-from onc.onc import ONC
 import shutil
 import os
+import tarfile
+import multiprocessing
 import numpy as np
 from scipy.stats import zscore
-from scipy.ndimage.filters import minimum_filter as min_filter
+from minfilter import min_filter
+from guided import guided_filter
 import json
+import re
+
+from collections import deque
+from temporal import Temporal
+
+try:
+    import cv2 as cv
+except ImportError:
+    cv = None
 
 """
 This function calculates the atmospheric light of the image
@@ -56,6 +68,24 @@ def reconstruct( img, at, t, t_0):
     J = np.abs(img - at) / np.maximum(t_0, t) + at 
     return np.floor((1 - (J - J.min()) / (J.max() - J.min())) * 255).astype(np.uint8)
 
+"""
+Gray level of a BGR image with `cv2.cvtColor`, or without OpenCV with 16 bit
+fixed point weights (within a gray level of it)
+"""
+def gray(src):
+    if cv is not None:
+        return cv.cvtColor(src, cv.COLOR_BGR2GRAY)
+    weighted = np.dot(src, np.array([7471, 38470, 19595], dtype=np.int32)) + 32768
+    return (weighted >> 16).astype(np.uint8)
+
+"""
+Refine the transmission with a guided filter on the gray image so it follows
+the edges of the scene.  With `subsample` the filter is computed on an image
+that many times smaller (see guided.py).
+"""
+def refine(src, t, subsample=1):
+    return guided_filter(gray(src), t, 15, 0.85, subsample)
+
 """
 Preprocess the image by performing zero-mean and clip
 the values to range [-1,1] and normalize [0,1]
@@ -75,98 +105,437 @@ def equalize(f):
     e = np.floor(H[f.flatten().astype('int')] * 255.)
     return e.reshape(f.shape)
 
-#Perform dehazing of image
-def dehaze(src, opts):
-    img = preprocess(src, opts["preprocess"]) 
+#Perform dehazing of image.  With a `temporal` cache the atmospheric light
+#(and transmission) of the last images of camera `key` can be reused.
+def dehaze(src, opts, temporal=None, key=None):
+    with stats.stage("preprocess"):
+        img = preprocess(src, opts["preprocess"]) 
 
-    img_dark = dark_channel(img, opts["wsize"])
-    at = atmosphere(img, img_dark, opts["ratio"])
-    t = transmission(img, at, opts["omega"], opts["wsize"])
+    at, t = temporal.reuse(key, src) if temporal is not None else (None, None)
+    fresh = at is None
+    if fresh:
+        with stats.stage("dark_channel"):
+            img_dark = dark_channel(img, opts["wsize"])
+        with stats.stage("atmosphere"):
+            at = atmosphere(img, img_dark, opts["ratio"])
+            if temporal is not None:
+                at = temporal.smooth(key, at)
+    else:
+        stats.count("temporal_reused")
+    if t is None:
+        with stats.stage("transmission"):
+            t = transmission(img, at, opts["omega"], opts["wsize"])
+    if fresh and temporal is not None:
+        temporal.store(key, at, t if opts["temporalTransmission"] else None)
     if opts["refine"]:
-        import cv2 as cv
-        from cv2.ximgproc import guidedFilter
-        t = guidedFilter(cv.cvtColor(src, cv.COLOR_BGR2GRAY), t, 15, 0.85)[:,:,np.newaxis]
+        with stats.stage("refine"):
+            t = refine(src, t, opts["refineSubsample"])[:,:,np.newaxis]
     
-    img = reconstruct(img, at, t, opts["t_0"])
+    with stats.stage("reconstruct"):
+        img = reconstruct(img, at, t, opts["t_0"])
    
     if opts["postprocess"]:
-        for i in np.arange(0,3):
-            img[:,:,i] = equalize(img[:,:,i])
+        with stats.stage("equalize"):
+            for i in np.arange(0,3):
+                img[:,:,i] = equalize(img[:,:,i])
     return img
 
-#Load user defined options from a json file 
-print("INFO: Loading user settings from json file")
-with open("params.json", "r") as f:
-    params = json.load(f)
-
-    onc_    = params["onc"]
-    search_ = params["search"]
-    opts    = params["dehaze"]
-
-    print("INFO: Connecting to ONC Oceans 2.0")
-    onc = ONC(onc_["token"], 
-              onc_["production"],
-              onc_["showInfo"], 
-              onc_["outPath"])
-
-    #Replace this value(s) with the desired camera or 
-    #video feeds you want to examine.
-    print("INFO: Performing data queries")
-    dps = onc.getDataProducts(filters={
-            'deviceCode' : search_["deviceCode"]})[0]
-
-    query = {
-        'dateFrom'          : search_["dateFrom"], 
-        'dateTo'            : search_["dateTo"], 
-        'dataProductCode'   : dps['dataProductCode'],
-        'extension'         : dps['extension'],
-        'deviceCode'        : search_["deviceCode"],
-    }
-    
-    print("INFO: Retrieve the data product info and download.")
-    orders = onc.orderDataProduct(
-                query, 
-                onc_["maxRetries"], 
-                onc_["downloadResultsOnly"], 
-                onc_["includeMetadataFile"])
-    
-    downloaded = [ order['file'] for order in orders['downloadResults'] if order['downloaded'] ] 
+"""
+Dehaze an image in horizontal strips of `stripHeight` rows so only a strip
+of float arrays is in memory at a time, like `dehaze` on the whole image.
+Each strip is read with a halo of rows around it for the dark channel window
+(and twice the guided filter radius and `refineSubsample`).  The statistics of the whole image are
+gathered in passes over the strips: the zscore of the columns, the
+atmospheric light, then the transmission (kept for the whole image) and the
+range of the reconstruction, which is normalized in a last pass.
+"""
+def dehaze_strips(src, opts):
+    h, w = src.shape[:2]
+    step = opts["stripHeight"]
+    halo_dark = opts["wsize"] // 2
+    subsample = opts["refineSubsample"] if opts["refine"] else 1
+    halo = halo_dark + (2 * 15 + 2 * subsample if opts["refine"] else 0)
+
+    #The rows [y0, y1) of every strip and the rows [a0, a1) with the halo.
+    #The halos start on a multiple of `subsample` so the subsampled guided
+    #filter of a strip uses the same blocks of pixels as the whole image.
+    def strips(margin):
+        for y0 in range(0, h, step):
+            y1 = min(y0 + step, h)
+            yield y0, y1, max(y0 - margin, 0) // subsample * subsample, min(y1 + margin, h)
+
+    with stats.stage("preprocess"):
+        if opts["preprocess"]:
+            #zscore of the columns like `preprocess`.  The rows are summed one
+            #after the other in float32 like NumPy does along the first axis.
+            mean = np.zeros(src.shape[1:], dtype=np.float32)
+            for row in src:
+                mean += row
+            mean /= h
+            var = np.zeros(src.shape[1:], dtype=np.float32)
+            for row in src:
+                var += np.square(row - mean)
+            std = np.sqrt(var / h)
+
+    def preprocessed(a0, a1):
+        img = src[a0:a1].astype(np.float32)
+        if opts["preprocess"]:
+            img -= mean
+            img /= std
+            np.clip(img, -1, 1, out=img)
+            img += 1.
+            img /= 2.
+        else:
+            img /= 255.
+        return img
+
+    #The pixels of a strip below its own threshold for the brightest pixels
+    #of the dark channel are also below the threshold of the whole image
+    with stats.stage("atmosphere"):
+        dark_values, bright = [], []
+        for y0, y1, a0, a1 in strips(halo_dark):
+            img = preprocessed(a0, a1)
+            img_dark = dark_channel(img, opts["wsize"])[y0-a0:y1-a0]
+            ind = img_dark >= img_dark.max()*(1-opts["ratio"])
+            dark_values.append(img_dark[ind])
+            bright.append(img[y0-a0:y1-a0][ind])
+        at = atmosphere(np.concatenate(bright), np.concatenate(dark_values), opts["ratio"])
+
+    t_full = np.empty((h, w), dtype=np.float32)
+    J_min, J_max = np.inf, -np.inf
+    for y0, y1, a0, a1 in strips(halo):
+        img = preprocessed(a0, a1)
+        with stats.stage("transmission"):
+            t = transmission(img, at, opts["omega"], opts["wsize"])
+        if opts["refine"]:
+            with stats.stage("refine"):
+                t = refine(src[a0:a1], t, opts["refineSubsample"])[:,:,np.newaxis]
+        t = t[y0-a0:y1-a0]
+        t_full[y0:y1] = t[:,:,0]
+        with stats.stage("reconstruct"):
+            J = np.abs(img[y0-a0:y1-a0] - at) / np.maximum(opts["t_0"], t) + at
+            J_min, J_max = min(J_min, J.min()), max(J_max, J.max())
+
+    out = np.empty(src.shape, dtype=np.uint8)
+    with stats.stage("reconstruct"):
+        for y0, y1, _, _ in strips(0):
+            J = np.abs(preprocessed(y0, y1) - at) / np.maximum(opts["t_0"], t_full[y0:y1,:,np.newaxis]) + at
+            out[y0:y1] = np.floor((1 - (J - J_min) / (J_max - J_min)) * 255).astype(np.uint8)
+
+    if opts["postprocess"]:
+        with stats.stage("equalize"):
+            for c in range(3):
+                f = out[:,:,c]
+                H = np.cumsum(np.bincount(f.ravel(), minlength=256)) / float(f.size)
+                f[:] = np.floor(H * 255.).astype(np.uint8)[f]
+    return out
+
+#The buffers of `dehaze_batch` for the last stack shape (N,H,W)
+_batch_buffers = {}
+
+"""
+The float32 buffers of `dehaze_batch` for stacks of (N,H,W) images, kept for
+the next stacks of the same shape (the batches of a tarfile).  Only the last
+shape is kept so a smaller last batch doesn't keep two sets.
+"""
+def batch_buffers(n, h, w):
+    if (n, h, w) not in _batch_buffers:
+        _batch_buffers.clear()
+        _batch_buffers[(n, h, w)] = (np.empty((n, h, w, 3), dtype=np.float32),
+                                     np.empty((n, h, w, 3), dtype=np.float32),
+                                     np.empty((n, h, w), dtype=np.float32),
+                                     np.empty((n, h, w), dtype=np.float32))
+    return _batch_buffers[(n, h, w)]
+
+"""
+Dehaze a stack of same sized images (N,H,W,3), like calling `dehaze` on each
+image.  Everything stays in float32 and is done in place in a few buffers the
+size of the stack, which are reused by the next stacks of the same shape.  Each
+image still gets its own atmospheric light and normalization.  The results can
+differ from `dehaze` by a gray level where the rounding differs.
+"""
+def dehaze_batch(stack, opts):
+    stack = np.asarray(stack)
+    n, h, w, _ = stack.shape
+    wsize = (1, opts["wsize"], opts["wsize"])
+
+    #img holds the preprocessed images, J the scaled images and then the
+    #reconstruction, dark the dark channel and then the transmission
+    img, J, j_min, dark = batch_buffers(n, h, w)
+
+    with stats.stage("preprocess"):
+        np.copyto(img, stack, casting="unsafe")
+        if opts["preprocess"]:
+            #zscore of every image along its rows, like `preprocess`
+            img -= img.mean(axis=1, keepdims=True)
+            img /= img.std(axis=1, keepdims=True)
+            np.clip(img, -1, 1, out=img)
+            img += 1.
+            img /= 2.
+        else:
+            img /= 255.
+
+    with stats.stage("dark_channel"):
+        np.min(img, axis=3, out=j_min)
+        min_filter(j_min, size=wsize, output=dark)
+    with stats.stage("atmosphere"):
+        at = np.empty((n, 1, 1, 3), dtype=np.float32)
+        for i in range(n):
+            at[i] = atmosphere(img[i], dark[i], opts["ratio"])
+    with stats.stage("transmission"):
+        np.divide(img, at, out=J)
+        np.min(J, axis=3, out=j_min)
+        t = min_filter(j_min, size=wsize, output=dark)
+        t *= -opts["omega"]
+        t += 1.
+    if opts["refine"]:
+        with stats.stage("refine"):
+            for i in range(n):
+                t[i] = refine(stack[i], t[i], opts["refineSubsample"])
+
+    with stats.stage("reconstruct"):
+        #J = |I - A| / max(t, t_0) + A, then normalized and inverted per image
+        np.subtract(img, at, out=J)
+        np.abs(J, out=J)
+        np.maximum(t, opts["t_0"], out=t)
+        J /= t[:,:,:,np.newaxis]
+        J += at
+        J_min = J.min(axis=(1,2,3), keepdims=True)
+        J -= J_min
+        J /= J.max(axis=(1,2,3), keepdims=True)
+        np.subtract(1., J, out=J)
+        J *= 255.
+        np.floor(J, out=J)
+        out = J.astype(np.uint8)
+
+    if opts["postprocess"]:
+        #The histogram equalization of every channel is a lookup table
+        with stats.stage("equalize"):
+            for i in range(n):
+                for c in range(3):
+                    f = out[i,:,:,c]
+                    H = np.cumsum(np.bincount(f.ravel(), minlength=256)) / float(f.size)
+                    f[:] = np.floor(H * 255.).astype(np.uint8)[f]
+    return out
+
+"""
+The camera of an image of the tarfile: the first group of the `cameraPattern`
+regular expression in its file name (or the whole match), or "" for all the
+images when there's no pattern
+"""
+def cameraKey(name, pattern):
+    match = re.search(pattern, os.path.basename(name)) if pattern else None
+    if match is None:
+        return ""
+    return match.group(1) if match.groups() else match.group(0)
+
+"""
+Dehaze a list of images, together with `dehaze_batch` when `batch` is set and
+they have the same size.  With a `temporal` cache they are dehazed one at a 
+time in order, `keys` are their cameras.  With `stripHeight` they are dehazed
+one at a time in strips.
+"""
+def dehazeImages(srcs, opts, keys=None, temporal=None):
+    with stats.stage("dehaze"):
+        if temporal is not None:
+            return [ dehaze(src, opts, temporal, key) for src, key in zip(srcs, keys) ]
+        if opts["stripHeight"]:
+            return [ dehaze_strips(src, opts) for src in srcs ]
+        if opts["batch"] and len(set(src.shape for src in srcs)) == 1:
+            return list(dehaze_batch(np.stack(srcs), opts))
+        return [ dehaze(src, opts) for src in srcs ]
+
+"""
+Dehaze the lists of images given by `batches` (with their names) and yield the
+dehazed lists in the same order.  With a pool, the lists are dehazed by its workers while the
+dehazed ones are written, up to two per worker at a time so the number of 
+images in memory stays bounded.  The time spent in the workers is not in the
+stats, the time waiting for them is (as `dehaze`).  The `temporal` cache is
+only used without a pool, the workers would each see some of the images.
+"""
+def dehazeBatches(batches, opts, pool=None, temporal=None):
+    pending = deque()
+    for names, srcs in batches:
+        if pool is None:
+            keys = [ cameraKey(name, opts["cameraPattern"]) for name in names ]
+            yield dehazeImages(srcs, opts, keys, temporal)
+            continue
+        pending.append(pool.apply_async(dehazeImages, (srcs, opts)))
+        if len(pending) >= 2 * opts["workers"]:
+            with stats.stage("dehaze"):
+                processed = pending.popleft().get()
+            yield processed
+    while pending:
+        with stats.stage("dehaze"):
+            processed = pending.popleft().get()
+        yield processed
+
+"""
+Dehaze the BMP images of a camera array tarfile and save them in a new
+`-dehazed.tgz` tarfile next to it.  With the `stream` option the images are
+read from the tarfile and written to the new one in memory, otherwise they
+are extracted to `outPath`.  With `workers` the images are dehazed in that 
+many processes, of `pool` if it is given so it can be shared by several
+tarfiles.  Returns the new tarfile name.  With the `stats` option the time 
+spent in every stage is written to `-dehazed.stats.json`.
+"""
+def processTar(tar_fn, outPath, opts, pool=None):
+    if pool is None and opts["workers"] > 1:
+        with multiprocessing.Pool(opts["workers"]) as pool:
+            return processTar(tar_fn, outPath, opts, pool)
+
+    stats.reset(enabled=bool(opts["stats"]))
+    stats.count("bytes_read", os.path.getsize(tar_fn))
+
+    #If we want to keep the original files than we need to save them somewhere else
+    new_tar_fn = tar_fn.replace(".tar", "-dehazed.tgz")
+    #The atmospheric light of the images of a camera can be reused
+    temporal = None
+    if opts["temporal"] and pool is None:
+        temporal = Temporal(opts["temporalWindow"], opts["temporalSmoothing"], 
+                            opts["temporalThreshold"])
+
+    if opts["stream"]:
+        streamTar(tar_fn, new_tar_fn, opts, pool, temporal)
+    else:
+        extractTar(tar_fn, new_tar_fn, outPath, opts, pool, temporal)
+    stats.count("bytes_written", os.path.getsize(new_tar_fn))
+
+    if opts["stats"]:
+        stats.export(new_tar_fn.replace(".tgz", ".stats.json"))
+    return new_tar_fn
+
+"""
+Dehaze the images of the tarfile `batch` at a time without extracting them: 
+the images are decoded from the tarfile members and the dehazed images are
+encoded straight into the new tarfile, in a `-dehazed` folder like 
+`extractTar` does.  Only a few batches of images are in memory at a time.
+"""
+def streamTar(tar_fn, new_tar_fn, opts, pool=None, temporal=None):
+    print("{}: Processing tarfile images".format(tar_fn))
+    batch = max(opts["batch"], 1)
+    with tarfile.open(tar_fn) as tar, tarfile.open(new_tar_fn, "w:gz") as new_tar:
+        members = utils.members(tar, "bmp")
+        out_dir = os.path.dirname(members[0].name) + "-dehazed"
+        utils.add_dir(new_tar, out_dir)
+
+        def read():
+            for i in range(0, len(members), batch):
+                with stats.stage("read"):
+                    srcs = [ imageio.imread(tar.extractfile(m).read(), format="bmp") 
+                             for m in members[i:i+batch] ]
+                yield [ m.name for m in members[i:i+batch] ], srcs
 
-    print("INFO: Downloaded: ", downloaded)
-    outPath = onc_["outPath"]
-    for tar_fn in downloaded:
-        #The camera array images come in a tarfile (.tar) that we need to extract 
+        for i, processed in zip(range(0, len(members), batch), 
+                                dehazeBatches(read(), opts, pool, temporal)):
+            with stats.stage("write"):
+                for m, img in zip(members[i:i+batch], processed):
+                    basename = os.path.basename(m.name)
+                    print("{}: Saving {} to {} ...".format(tar_fn, basename, out_dir))
+                    utils.add_bytes(new_tar, os.path.join(out_dir, basename), 
+                                    imageio.imwrite("<bytes>", img, format="bmp"))
+            stats.count("images", len(processed))
+
+"""
+Dehaze the images of the tarfile by extracting them to `outPath`, saving the
+dehazed images in a `-dehazed` folder there and packing it
+"""
+def extractTar(tar_fn, new_tar_fn, outPath, opts, pool=None, temporal=None):
+    #The camera array images come in a tarfile (.tar) that we need to extract 
+    with stats.stage("untar"):
         images = utils.untar(tar_fn, outPath, "bmp")
-        
-
-        print("{}: Processing tarfile images".format(tar_fn))
-        processed = [ dehaze(imageio.imread(os.path.join(outPath, img)), opts) for img in images ]
-       
-        #If we want to keep the original files than we need to save them somewhere else
-        new_tar_fn = tar_fn.replace(".tar", "-dehazed.tgz")
-        source_dir = os.path.dirname(images[0])
-        out_dir = source_dir + "-dehazed"
-        os.mkdir(os.path.join(outPath, out_dir))
-       
-
-        #Save the images
-        for i, img in enumerate(processed):
-            basename = os.path.basename(images[i])
+    
+    source_dir = os.path.dirname(images[0])
+    out_dir = source_dir + "-dehazed"
+    os.mkdir(os.path.join(outPath, out_dir))
+
+    print("{}: Processing tarfile images".format(tar_fn))
+    #The images of a camera array have the same size, so `batch` of them 
+    #can be dehazed together
+    batch = max(opts["batch"], 1)
+    def read():
+        for i in range(0, len(images), batch):
+            with stats.stage("read"):
+                srcs = [ imageio.imread(os.path.join(outPath, img)) for img in images[i:i+batch] ]
+            yield images[i:i+batch], srcs
+
+    #Save the images as they are dehazed
+    for i, processed in zip(range(0, len(images), batch), 
+                            dehazeBatches(read(), opts, pool, temporal)):
+        for image, img in zip(images[i:i+batch], processed):
+            basename = os.path.basename(image)
             print("{}: Saving {} to {} ...".format(tar_fn, basename, out_dir))
-            imageio.imwrite(os.path.join(outPath,out_dir,basename), img)
+            with stats.stage("write"):
+                imageio.imwrite(os.path.join(outPath,out_dir,basename), img)
+        stats.count("images", len(processed))
 
-        #Create the tar file and remove the directories we created
+    #Create the tar file and remove the directories we created
+    with stats.stage("tar"):
         utils.tar(new_tar_fn, outPath, out_dir)
-        
-        print("{}: Removing source directory".format(tar_fn))
-        shutil.rmtree(os.path.join(outPath, out_dir)) 
-        shutil.rmtree(os.path.join(outPath, source_dir)) 
+    
+    print("{}: Removing source directory".format(tar_fn))
+    shutil.rmtree(os.path.join(outPath, out_dir)) 
+    shutil.rmtree(os.path.join(outPath, source_dir)) 
+
+if __name__ == "__main__":
+    from onc.onc import ONC
+
+    #Load user defined options from a json file 
+    print("INFO: Loading user settings from json file")
+    with open("params.json", "r") as f:
+        params = json.load(f)
+
+        onc_    = params["onc"]
+        search_ = params["search"]
+        opts    = params["dehaze"]
+
+        print("INFO: Connecting to ONC Oceans 2.0")
+        onc = ONC(onc_["token"], 
+                  onc_["production"],
+                  onc_["showInfo"], 
+                  onc_["outPath"])
+
+        #Replace this value(s) with the desired camera or 
+        #video feeds you want to examine.
+        print("INFO: Performing data queries")
+        dps = onc.getDataProducts(filters={
+                'deviceCode' : search_["deviceCode"]})[0]
+
+        query = {
+            'dateFrom'          : search_["dateFrom"], 
+            'dateTo'            : search_["dateTo"], 
+            'dataProductCode'   : dps['dataProductCode'],
+            'extension'         : dps['extension'],
+            'deviceCode'        : search_["deviceCode"],
+        }
+    
+        print("INFO: Retrieve the data product info and download.")
+        orders = onc.orderDataProduct(
+                    query, 
+                    onc_["maxRetries"], 
+                    onc_["downloadResultsOnly"], 
+                    onc_["includeMetadataFile"])
+    
+        downloaded = [ order['file'] for order in orders['downloadResults'] if order['downloaded'] ] 
+
+        print("INFO: Downloaded: ", downloaded)
+        outPath = onc_["outPath"]
+
+        #The images of every tarfile are dehazed by the same pool of workers
+        workers = opts["workers"]
+        pool = multiprocessing.Pool(workers) if workers > 1 else None
+        for tar_fn in downloaded:
+            processTar(tar_fn, outPath, opts, pool)
+
+            if not opts["keepOriginal"]:
+                print("{}: removing original download.")
+                os.remove(tar_fn) 
 
-        if not opts["keepOriginal"]:
-            print("{}: removing original download.")
-            os.remove(tar_fn) 
+            print("{}:  Finished.".format(tar_fn))
 
-        print("{}:  Finished.".format(tar_fn))
+        if pool is not None:
+            pool.close()
+            pool.join()
 
-print("INFO: Script finished")
+    print("INFO: Script finished")
 
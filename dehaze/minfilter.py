@@ -0,0 +1,61 @@
+"""
+Minimum filter whose cost doesn't depend on the size of the window (van Herk
+/ Gil-Werman).  Along each axis the signal is cut in blocks of the window
+size, and the running minimum of every block is taken forwards (g) and
+backwards (h).  A window then spans at most two blocks, so its minimum is
+min(h[x], g[x + size - 1]): three comparisons per pixel and axis whatever the
+size.  A rectangular window is separable, so the axes are filtered one after
+the other.
+
+The borders are handled like `scipy.ndimage.minimum_filter` (mode "reflect")
+and the results are the same, in the dtype of the input.
+"""
+
+import numpy as np
+
+"""
+Minimum of every `size` long window along `axis`, centered like scipy does.
+The axis is moved first so every step of the running minimums is done on 
+whole contiguous rows of the other axes.
+"""
+def min_filter_1d(img, size, axis=-1):
+    if size == 1:
+        return img.copy()
+    img = np.moveaxis(img, axis, 0)
+    n = len(img)
+    left = size // 2
+
+    #Reflect the borders, then fill the last block with the largest value
+    nblocks = -(-(n + size - 1) // size)
+    fill = np.inf if img.dtype.kind == "f" else np.iinfo(img.dtype).max
+    g = np.pad(img, [(left, nblocks * size - n - left)] + [(0, 0)] * (img.ndim - 1), 
+               mode="symmetric")
+    g[n + size - 1:] = fill
+    h = g.copy()
+
+    #Running minimums forwards (g) and backwards (h) in every block
+    g_blocks = g.reshape((nblocks, size) + img.shape[1:])
+    h_blocks = h.reshape((nblocks, size) + img.shape[1:])
+    for i in range(1, size):
+        np.minimum(g_blocks[:, i], g_blocks[:, i - 1], out=g_blocks[:, i])
+        np.minimum(h_blocks[:, size - 1 - i], h_blocks[:, size - i], out=h_blocks[:, size - 1 - i])
+
+    out = np.minimum(h[:n], g[size - 1:size - 1 + n])
+    return np.moveaxis(out, 0, axis)
+
+"""
+Minimum filter of `img` with a window of `size` (an int for every axis or one
+per axis), a drop-in for `scipy.ndimage.minimum_filter(img, size, output)`
+"""
+def min_filter(img, size, output=None):
+    sizes = [size] * img.ndim if np.isscalar(size) else list(size)
+    out = img
+    for axis, s in enumerate(sizes):
+        if s > 1:
+            out = min_filter_1d(out, s, axis)
+    if out is img:
+        out = img.copy()
+    if output is None:
+        return out
+    np.copyto(output, out)
+    return output
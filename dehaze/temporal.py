@@ -0,0 +1,60 @@
+"""
+Reuse of the atmospheric light (and optionally the transmission) across the
+consecutive images of a camera.  The water conditions change slowly, so after
+a fresh estimate the next images of the camera reuse it for up to `window`
+images, unless a small thumbnail of the image changed by more than
+`threshold` gray levels since the estimate.  A fresh estimate is averaged with
+the last one (`smoothing` is the weight of the new one) so the brightness of
+the dehazed images doesn't flicker, except after a change of scene.
+"""
+
+import numpy as np
+
+class Temporal(object):
+    def __init__(self, window=10, smoothing=0.5, threshold=4.):
+        self._window = window
+        self._smoothing = smoothing
+        self._threshold = threshold
+        self._cameras = {}
+        self.reused = 0
+
+    #Mean of 24x32 blocks of the gray image
+    def _thumb(self, src):
+        h, w = src.shape[:2]
+        bh, bw = max(h // 24, 1), max(w // 32, 1)
+        gray = src[:h // bh * bh, :w // bw * bw].astype(np.float32)
+        if gray.ndim == 3:
+            gray = gray.mean(axis=2)
+        return gray.reshape(h // bh, bh, w // bw, bw).mean(axis=(1,3))
+
+    #The thumbnail is about 24x32 whatever the size, so images of another size
+    #are always a change of scene
+    def _changed(self, camera):
+        return camera["shape"] != self._shape \
+               or np.abs(self._thumbnail - camera["thumb"]).mean() > self._threshold
+
+    #The atmospheric light and transmission (None if it isn't kept) of camera
+    #`key` that can be used for `src`, or None, None if a fresh estimate is 
+    #needed.  Called first for every image.
+    def reuse(self, key, src):
+        self._thumbnail = self._thumb(src)
+        self._shape = src.shape
+        camera = self._cameras.get(key)
+        if camera is None or camera["age"] >= self._window or self._changed(camera):
+            return None, None
+        camera["age"] += 1
+        self.reused += 1
+        return camera["at"], camera["t"]
+
+    #Average a fresh atmospheric light of camera `key` with the last one, 
+    #unless the scene changed
+    def smooth(self, key, at):
+        camera = self._cameras.get(key)
+        if camera is None or self._changed(camera):
+            return at
+        return (self._smoothing * at + (1 - self._smoothing) * camera["at"]).astype(at.dtype)
+
+    #Keep the fresh estimate of camera `key`
+    def store(self, key, at, t=None):
+        self._cameras[key] = { "thumb" : self._thumbnail, "shape" : self._shape, 
+                               "at" : at, "t" : t, "age" : 0 }
@@ -1,6 +1,11 @@
 import tarfile
 import importlib
 import os
+import io
+import time
+import threading
+import math
+import json
 
 def install_and_import(module,package):
     try:
@@ -28,3 +33,170 @@ def untar(tar_fn, outPath, filetype="bmp"):
 def tar(tar_fn, outPath, source_dir):
     with tarfile.open(tar_fn, "w:gz") as tar:
         tar.add(os.path.join(outPath, source_dir), arcname=source_dir)
+
+#The members of an open tarfile that are `filetype` files, without extracting
+def members(tar, filetype="bmp"):
+    return [ m for m in tar.getmembers() if m.isfile() and m.name.endswith(filetype) ]
+
+#Add a folder to an open tarfile
+def add_dir(tar, name):
+    info = tarfile.TarInfo(name)
+    info.type = tarfile.DIRTYPE
+    info.mode = 0o755
+    info.mtime = time.time()
+    tar.addfile(info)
+
+#Add a file with the content `data` (bytes) to an open tarfile
+def add_bytes(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mode = 0o644
+    info.mtime = time.time()
+    tar.addfile(info, io.BytesIO(data))
+
+"""
+Run `fn(*args)` in a child process and return its result and the peak
+resident memory of the child in MB, so every run is measured on its own.
+Unix only.
+"""
+def run_isolated(fn, *args):
+    import multiprocessing
+    import resource
+    import sys
+
+    def child(conn):
+        result = fn(*args)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        #Linux gives kB, macOS bytes
+        conn.send((result, peak / (1024. ** 2 if sys.platform == "darwin" else 1024.)))
+        conn.close()
+
+    context = multiprocessing.get_context("fork")
+    parent_conn, child_conn = context.Pipe(duplex=False)
+    process = context.Process(target=child, args=(child_conn,))
+    process.start()
+    child_conn.close()
+    try:
+        result = parent_conn.recv()
+    except EOFError:
+        raise RuntimeError("{} failed in the child process".format(fn.__name__))
+    finally:
+        process.join()
+    return result
+
+class Timer(object):
+    def __init__(self, verbose=False, name=None, stats=None):
+        self.verbose = verbose
+        self.name = name
+        self.stats = stats
+
+    def __enter__(self):
+        if self.stats is not None:
+            self.stats._push(self.name)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.end = time.time()
+        self.secs = self.end - self.start
+        self.msecs = self.secs * 1000  # millisecs
+        if self.stats is not None:
+            self.stats._pop(self.secs)
+        if self.verbose:
+            print('Runtime: %f mins (%f secs)' % ((self.secs / 60.), self.secs))
+
+class _NoTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+_NO_TIMER = _NoTimer()
+
+"""
+Collects where the time of a run goes: the time spent in named stages, which
+can be nested ("analyse/bg_model"), a histogram of how long each stage took,
+and counters.  While it is disabled `stage` only returns a shared object that
+does nothing, so the instrumented code costs next to nothing.  Every thread 
+has its own nesting of stages.
+
+    with stats.stage("decode"):
+        ...
+    stats.count("frames_read")
+"""
+class Stats(object):
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def reset(self, enabled=None):
+        if enabled is not None:
+            self.enabled = enabled
+        self._stages = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._start = time.time()
+
+    def stage(self, name):
+        if not self.enabled:
+            return _NO_TIMER
+        return Timer(name=name, stats=self)
+
+    #Time every item taken from `iterable` as the stage `name`
+    def timed(self, iterable, name):
+        if not self.enabled:
+            return iterable
+        return self._timed(iter(iterable), name)
+
+    def _timed(self, iterator, name):
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def count(self, name, n=1):
+        if self.enabled:
+            with self._lock:
+                self._counters[name] = self._counters.get(name, 0) + n
+
+    def _push(self, name):
+        path = getattr(self._local, "path", ())
+        self._local.path = path + (name,)
+
+    def _pop(self, secs):
+        path = self._local.path
+        self._local.path = path[:-1]
+        #Histogram buckets are powers of two of milliseconds
+        bucket = 2. ** max(math.ceil(math.log2(max(secs * 1000, 1e-3))), -4)
+        with self._lock:
+            stage = self._stages.setdefault("/".join(path), 
+                                            { "calls" : 0, "secs" : 0., "histogram_ms" : {} })
+            stage["calls"] += 1
+            stage["secs"] += secs
+            stage["histogram_ms"][bucket] = stage["histogram_ms"].get(bucket, 0) + 1
+
+    #The stages (sorted by name, so nested stages follow their parent), the 
+    #counters and the seconds since the reset
+    def report(self):
+        with self._lock:
+            stages = {}
+            for path in sorted(self._stages):
+                stage = dict(self._stages[path])
+                stage["histogram_ms"] = { "{:g}".format(bucket) : n for bucket, n 
+                                          in sorted(stage["histogram_ms"].items()) }
+                stages[path] = stage
+            return { "secs"     : time.time() - self._start,
+                     "stages"   : stages,
+                     "counters" : dict(self._counters) }
+
+    def export(self, json_fn):
+        with open(json_fn, "w") as f:
+            json.dump(self.report(), f, indent=4)
+
+#The stats of this process, disabled until `stats.reset(enabled=True)`
+stats = Stats()
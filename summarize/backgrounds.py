@@ -0,0 +1,97 @@
+"""
+Background models PCH can use to find the foreground pixels of a frame.  They
+all work like the OpenCV background subtractors: `apply(frame, fgmask,
+learningRate)` returns a uint8 mask with 255 for foreground and 0 for
+background pixels, written in `fgmask` if it is given.
+
+  mog     : OpenCV Gaussian Mixture Model (needs opencv-contrib), the original
+  mog2    : OpenCV MOG2, shadows are not detected
+  knn     : OpenCV K-nearest neighbours, shadows are not detected
+  average : NumPy running average with a running variance per pixel
+  median  : NumPy approximate running median, the median moves one gray
+            level towards every frame
+"""
+
+import cv2 as cv
+import numpy as np
+
+BACKENDS = ("mog", "mog2", "knn", "average", "median")
+
+"""
+Running average of every pixel and of its squared deviation.  A pixel is
+foreground when it is more than `deviations` standard deviations away from
+its average.
+"""
+class RunningAverage(object):
+    def __init__(self, history, deviations=2.5, min_variance=16.):
+        self._history = history
+        self._deviations = deviations
+        self._min_variance = min_variance
+        self._mean = None
+
+    def apply(self, frame, fgmask=None, learningRate=-1):
+        rate = learningRate if learningRate >= 0 else 1. / self._history
+        frame = frame.astype(np.float32)
+        if self._mean is None:
+            self._mean = frame.copy()
+            self._variance = np.full(frame.shape, self._min_variance, dtype=np.float32)
+            self._diff = np.empty(frame.shape, dtype=np.float32)
+        diff = np.subtract(frame, self._mean, out=self._diff)
+
+        mask = np.square(diff) > self._deviations ** 2 * self._variance
+        if fgmask is None or fgmask.shape != frame.shape:
+            fgmask = np.empty(frame.shape, dtype=np.uint8)
+        np.multiply(mask, 255, out=fgmask, dtype=np.uint8, casting="unsafe")
+
+        #mean += rate * diff, variance += rate * (diff^2 - variance)
+        self._mean += rate * diff
+        np.square(diff, out=diff)
+        diff -= self._variance
+        self._variance += rate * diff
+        np.maximum(self._variance, self._min_variance, out=self._variance)
+        return fgmask
+
+"""
+Approximate running median: every frame, the background moves one gray level
+towards the pixel.  A pixel is foreground when it is more than `threshold`
+gray levels away from the background.  Only integer operations are used.
+"""
+class RunningMedian(object):
+    def __init__(self, history, threshold=20):
+        self._history = history
+        self._threshold = threshold
+        self._median = None
+
+    def apply(self, frame, fgmask=None, learningRate=-1):
+        if self._median is None:
+            self._median = frame.astype(np.int16)
+            self._diff = np.empty(frame.shape, dtype=np.int16)
+        diff = np.subtract(frame, self._median, out=self._diff, dtype=np.int16)
+
+        if fgmask is None or fgmask.shape != frame.shape:
+            fgmask = np.empty(frame.shape, dtype=np.uint8)
+        mask = np.abs(diff) > self._threshold
+        np.multiply(mask, 255, out=fgmask, dtype=np.uint8, casting="unsafe")
+
+        #A learning rate of 0 freezes the background like the OpenCV models
+        if learningRate != 0:
+            self._median += np.sign(diff, out=diff)
+        return fgmask
+
+"""
+Create the background model `name` (one of BACKENDS) that remembers about
+`history` frames
+"""
+def create(name, history):
+    if name == "mog":
+        return cv.bgsegm.createBackgroundSubtractorMOG(history=history)
+    if name == "mog2":
+        return cv.createBackgroundSubtractorMOG2(history=history, detectShadows=False)
+    if name == "knn":
+        return cv.createBackgroundSubtractorKNN(history=history, detectShadows=False)
+    if name == "average":
+        return RunningAverage(history)
+    if name == "median":
+        return RunningMedian(history)
+    raise ValueError("'{}' is not a background model, use one of {}".format(
+                        name, ", ".join(BACKENDS)))
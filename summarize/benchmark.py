@@ -0,0 +1,684 @@
+#!/usr/env/python3
+"""
+
+Offline benchmark of the PCH summarization algorithm.  No ONC token or network
+connection is needed: a synthetic grayscale video (sensor noise plus a moving
+object) is generated and fed through `PCH.update_model`.  The per pixel
+(np.vectorize) activation/adjust functions used previously are kept here as the
+reference "before" engine so both the speed and the labels can be compared.
+
+If a number of shards is given, a longer synthetic video is also written to
+disk and the keep/drop decisions of the sharded analysis are compared to the
+serial one.
+
+With `backgrounds`, every background model of backgrounds.py is run on
+synthetic underwater-like footage (caustics, flicker and marine snow, with a
+fish that comes and goes) and its speed and keep/drop decisions are compared
+to the MOG ones.
+
+With `sampling`, a mostly quiet synthetic video is summarized with fixed and
+with adaptive sampling (see `adaptiveSampling`) and the number of analysed
+frames, the kept frames and how many of the frames with the object in the
+scene are kept are compared.
+
+With `tiles`, the underwater-like footage is run through the model with a ROI
+(see `roi`), in tiles (see `tile_size`) and with early exit, and the speed and
+decisions are compared.  With `pyramid`, the same is done for the coarse to
+fine analysis (see `pyramid`) on footage where the fish is mostly gone.
+
+With `guided`, the guided filter of guided.py is compared to the opencv-contrib
+one on the event maps of the underwater-like footage, at full resolution and
+subsampled (see `filter_subsample`): milliseconds per frame, pixels that
+differ, and keep/drop decisions that agree.
+
+With `cuts`, a video with B-frames whose frames show their own index is cut
+into segments with a stream copy and with `boundaryReencode`, and the decoded
+frame indices of each summary are checked: every frame of the segments once
+and in order (only whole GOPs more with the copy), at the frame rate of the
+video.
+
+With `suite`, a synthetic underwater-like video is written and decoded,
+analysed, encoded and summarized (with the `encode` and `segments` outputs),
+each in its own process, and the frames per second, seconds per stage and peak
+memory of every case are printed as JSON, or written to `report.json` if it
+is given, so runs can be compared across releases.
+
+From the `summarize` folder:
+    python3 benchmark.py [nframes] [shards]
+    python3 benchmark.py backgrounds [nframes]
+    python3 benchmark.py sampling [nframes]
+    python3 benchmark.py tiles [nframes]
+    python3 benchmark.py pyramid [nframes]
+    python3 benchmark.py guided [nframes]
+    python3 benchmark.py cuts [nframes]
+    python3 benchmark.py suite [nframes] [report.json]
+"""
+
+import sys
+import os
+import json
+import time
+import tempfile
+import shutil
+import platform
+import subprocess
+import cv2 as cv
+import numpy as np
+
+import backgrounds
+import guided
+import utils
+from pch import PCH, PyramidPCH, PixelEvent
+
+"""
+Generate a grayscale video of `nframes` frames with gaussian noise and a
+bright square moving across the scene.  If `burst` is set the square is only
+in the scene for `burst` frames, then gone for `quiet` times as long.
+"""
+def synthetic_frames(nframes, frame_size=(608,800), seed=0, burst=0, quiet=1):
+    rng = np.random.RandomState(seed)
+    h, w = frame_size
+    background = rng.randint(40, 90, size=frame_size).astype(np.float32)
+    frames = []
+    for i in range(nframes):
+        frame = background + rng.normal(0, 4, size=frame_size)
+        if not burst or (i // burst) % (quiet + 1) == 0:
+            x = (i * 23) % (w - 60)
+            y = h // 3 + int(40 * np.sin(i / 5.))
+            frame[y:y+60, x:x+60] += 120
+        frames.append(np.clip(frame, 0, 255).astype(np.uint8))
+    return frames
+
+"""
+Generate grayscale underwater-like frames: a murky background lit by drifting
+caustics and a flickering light, marine snow falling through the scene and a
+fish that swims across for `burst` frames, then is gone for `quiet` times as
+long.
+"""
+def underwater_frames(nframes, frame_size=(608,800), seed=0, burst=20, particles=40, quiet=1):
+    rng = np.random.RandomState(seed)
+    h, w = frame_size
+    y, x = np.mgrid[0:h, 0:w].astype(np.float32)
+    background = cv.blur(rng.randint(30, 80, size=frame_size).astype(np.float32), (15,15))
+    snow = np.column_stack((rng.uniform(0, h, particles), rng.uniform(0, w, particles)))
+    frames = []
+    for i in range(nframes):
+        caustics = 6 * np.sin(x / 37. + i / 3.) * np.sin(y / 23. - i / 5.)
+        frame = background * (1 + 0.05 * np.sin(i / 2.)) + caustics
+        frame += rng.normal(0, 3, size=frame_size)
+
+        #Marine snow drifts down and a bit sideways
+        snow += (rng.uniform(2, 6, particles)[:,None] * [1, 0.3])
+        snow %= [h, w]
+        for py, px in snow.astype(int):
+            frame[py:py+2, px:px+2] += 25
+
+        if (i // burst) % (quiet + 1) == 0:
+            fx = (i * 17) % (w - 120)
+            fy = h // 2 + int(60 * np.sin(i / 7.))
+            frame[fy:fy+50, fx:fx+120] += 45
+        frames.append(np.clip(frame, 0, 255).astype(np.uint8))
+    return frames
+
+"""
+Replace the matrix functions of `pch` with the per pixel implementation
+that was used before the array-native kernels.
+"""
+def use_per_pixel_functions(pch):
+    def adjust(t):
+        return -2.*t*t*t + 3.*t*t
+
+    def activation(a,b,c):
+        return 0 if c < pch._T_H \
+                 else PixelEvent.NEW_MOTION \
+                 if abs(a-b) > pch._T_M \
+                 else \
+                 PixelEvent.OLD_MOTION
+
+    pch.activation = np.vectorize(activation)
+    pch.adjust = np.vectorize(adjust)
+
+"""
+Run the frames through a freshly initialized model and return the frames per
+second along with the event matrix of every frame.
+"""
+def run(pch, frames, fps=15):
+    pch.initialize(frames[0].shape, fps)
+    events = []
+    start = time.time()
+    for prev, curr in zip(frames[:-1], frames[1:]):
+        pch.update_model(prev, curr)
+        events.append(np.array(pch.E_matrix, dtype=np.uint8))
+    secs = time.time() - start
+    return (len(frames) - 1) / secs, events
+
+"""
+Same as `run` but the frames are given to the model in stacks of `chunk` frames
+"""
+def run_batch(pch, frames, chunk=16, fps=15):
+    pch.initialize(frames[0].shape, fps)
+    counts = []
+    start = time.time()
+    for i in range(1, len(frames), chunk):
+        counts.extend(pch.update_model_batch(frames[i-1], 
+                                             np.stack(frames[i:i+chunk]), 
+                                             counts=True))
+    secs = time.time() - start
+    return (len(frames) - 1) / secs, counts
+
+"""
+Run the frames through the model one pair at a time and in stacks of `chunk`
+frames, both with a ROI (and `kargs`), and return the number of labels of the
+event maps that differ
+"""
+def batch_roi_mismatch(frames, chunk=16, fps=15, **kargs):
+    h, w = frames[0].shape
+    roi = np.zeros((h, w), dtype=np.uint8)
+    roi[h//8:h*7//8, w//16:w*15//16] = 255
+    roi_fn = os.path.join(tempfile.mkdtemp(), "roi.png")
+    cv.imwrite(roi_fn, roi)
+
+    pch = PCH(roi=roi_fn, **kargs)
+    pch.initialize((h, w), fps)
+    serial = [ pch.update_model(prev, curr).copy() for prev, curr in zip(frames[:-1], frames[1:]) ]
+    pch = PCH(roi=roi_fn, **kargs)
+    pch.initialize((h, w), fps)
+    batched = np.concatenate([ pch.update_model_batch(frames[i-1], np.stack(frames[i:i+chunk]))
+                               for i in range(1, len(frames), chunk) ])
+    shutil.rmtree(os.path.dirname(roi_fn))
+    return sum(np.count_nonzero(a != b) for a, b in zip(serial, batched))
+
+"""
+Write a synthetic color video where the object comes and goes to `video_fn`
+"""
+def synthetic_video(video_fn, nframes, fps=15, frame_size=(240,320), quiet=1):
+    import imageio
+    writer = imageio.get_writer(video_fn, fps=fps)
+    for frame in synthetic_frames(nframes, frame_size, burst=4*fps, quiet=quiet):
+        writer.append_data(np.dstack((frame, frame, frame)))
+    writer.close()
+
+"""
+Return the fraction of sampled frames where analysing the video in `shards`
+parts decides differently than analysing it in one go.
+"""
+def shard_disagreement(video_fn, opts, shards):
+    import imageio
+    import reduce_script
+
+    video = imageio.get_reader(video_fn, 'ffmpeg')
+    fps = video.get_meta_data()['fps']
+    nframes = int(video.get_meta_data()['duration'] * fps)
+    video.close()
+
+    frame_size = (608,800)
+    kept = lambda analysed: set(row[0] for row in analysed if row[1] > opts["sampleThreshold"])
+    serial = kept(reduce_script.analyseShard(video_fn, opts, frame_size, fps, 0, 0))
+    sharded = kept(reduce_script.analyseShards(video_fn, opts, frame_size, fps, nframes, shards))
+    nsampled = len(range(0, nframes, opts['samplingRate']))
+    return len(serial ^ sharded) / float(nsampled)
+
+"""
+Write a video of `nframes` where each frame shows its index in binary (one
+white block per set bit), encoded with x264 with B-frames so that the decoding
+order isn't the display order
+"""
+def index_video(video_fn, nframes, fps=15, gop=30, frame_size=(128,160)):
+    import imageio
+    writer = imageio.get_writer(video_fn, fps=fps, codec="libx264", 
+                                ffmpeg_params=["-g", str(gop), "-bf", "3"])
+    h, w = frame_size[0] // 2, frame_size[1] // 5
+    for i in range(nframes):
+        frame = np.zeros(frame_size + (3,), np.uint8)
+        for bit in range(10):
+            if i >> bit & 1:
+                frame[bit//5*h:(bit//5+1)*h, bit%5*w:(bit%5+1)*w] = 255
+        writer.append_data(frame)
+    writer.close()
+
+"""
+Decode the frame indices written by `index_video` and the frame rate
+"""
+def frame_indices(video_fn, frame_size=(128,160)):
+    import imageio
+    video = imageio.get_reader(video_fn, 'ffmpeg')
+    h, w = frame_size[0] // 2, frame_size[1] // 5
+    indices = []
+    for frame in video:
+        gray = frame.mean(axis=2)
+        #The middle of each block, away from the compression ringing
+        indices.append(sum(1 << bit for bit in range(10) 
+                           if gray[bit//5*h + h//4:bit//5*h + 3*h//4, 
+                                   bit%5*w + w//4:bit%5*w + 3*w//4].mean() > 128))
+    fps = video.get_meta_data()['fps']
+    video.close()
+    return indices, fps
+
+"""
+Cut `segments` out of an `index_video` with a stream copy and with
+`boundaryReencode` and return, for each, whether the decoded frames and the
+frame rate are right, the number of frames and the frame rate of the summary
+"""
+def check_cuts(nframes, segments, fps=15):
+    import segments as seg
+
+    out_dir = tempfile.mkdtemp()
+    video_fn = os.path.join(out_dir, "index.mp4")
+    index_video(video_fn, nframes, fps)
+    expected = [ i for start, end in segments for i in range(start, end) ]
+    results = []
+    for reencode in (False, True):
+        out_fn = os.path.join(out_dir, "cut{}.mp4".format(int(reencode)))
+        seg.cut(video_fn, out_fn, segments, fps, reencode)
+        indices, out_fps = frame_indices(out_fn)
+        if reencode:
+            exact = indices == expected
+        else:
+            #Whole GOPs: each frame once, in order, and all of the segments
+            exact = indices == sorted(set(indices)) and set(expected) <= set(indices)
+        results.append((exact and abs(out_fps - fps) < 0.01, len(indices), out_fps))
+
+    shutil.rmtree(out_dir)
+    return results
+
+"""
+Summarize the video with fixed and with adaptive sampling (only the segments
+are written) and return, for each, the number of analysed frames, the number
+of kept frames and the fraction of the `events` frames (where the object is in
+the scene) that are kept.
+"""
+def adaptive_sampling(video_fn, opts, events):
+    import reduce_script
+    import novelty
+
+    out_dir = tempfile.mkdtemp()
+    results = []
+    for adaptive in (0, 1):
+        out_fn = os.path.join(out_dir, "summary{}.mp4".format(adaptive))
+        reduce_script.runVideo(video_fn, out_fn, dict(opts, adaptiveSampling=adaptive, 
+                                                      output="segments", index=1, 
+                                                      shards=1, checkpointInterval=0))
+        _, columns = novelty.loadIndex(os.path.join(out_dir, "summary{}.index".format(adaptive)))
+        with open(os.path.join(out_dir, "summary{}.json".format(adaptive)), "r") as f:
+            kept = set()
+            for segment in json.load(f)["segments"]:
+                kept.update(range(segment["start"], segment["end"]))
+        results.append((len(columns["frame"]), len(kept), 
+                        len(kept & events) / float(max(len(events), 1))))
+        del columns
+
+    shutil.rmtree(out_dir)
+    return results
+
+"""
+Run the frames through every background model and return, for each, the
+frames per second and the fraction of frames where the keep/drop decision
+(more than `sampleThreshold` new motion events) agrees with the MOG one.
+"""
+def compare_backgrounds(frames, sampleThreshold=10, fps=15):
+    results = {}
+    for name in backgrounds.BACKENDS:
+        try:
+            speed, counts = run_counts(PCH(background=name, in_place=True), frames, fps)
+        except AttributeError as e:
+            #cv.bgsegm is only in the contrib build
+            print("{:8s}: not available ({})".format(name, e))
+            continue
+        results[name] = (speed, counts > sampleThreshold)
+
+    reference = results.get("mog", next(iter(results.values())))[1]
+    return { name : (speed, np.mean(keep == reference)) 
+             for name, (speed, keep) in results.items() }
+
+"""
+Like `run` but only keep the number of new motion events of every frame.
+With `stop_after`, the tiled model may stop counting after that many events.
+"""
+def run_counts(pch, frames, fps=15, stop_after=None):
+    pch.initialize(frames[0].shape, fps)
+    counts = []
+    start = time.time()
+    for prev, curr in zip(frames[:-1], frames[1:]):
+        result = pch.update_model(prev, curr, stop_after)
+        counts.append(np.count_nonzero(result == PixelEvent.NEW_MOTION))
+    secs = time.time() - start
+    return (len(frames) - 1) / secs, np.array(counts)
+
+"""
+Run the frames through the full resolution model and the coarse to fine one
+(see `pyramid`) and return for each the frames per second, the fraction of
+frames only analysed at the low resolution and the fraction of frames where
+the keep/drop decision agrees with the full resolution model.
+"""
+def compare_pyramid(frames, sampleThreshold=10, scale=4, fps=15):
+    speed, counts = run_counts(PCH(in_place=True), frames, fps)
+    reference = counts > sampleThreshold
+    pyramid = PyramidPCH(scale, in_place=True)
+    speed_pyramid, counts = run_counts(pyramid, frames, fps)
+    screened = pyramid.screened / float(len(frames) - 1)
+    return [ ("full resolution", speed, 0., 1.),
+             ("1/{} then full".format(scale), speed_pyramid, screened, 
+              np.mean((counts > sampleThreshold) == reference)) ]
+
+"""
+Run the frames through the whole frame model, then the tiled model with and
+without early exit, all with a ROI that leaves out the seafloor (the bottom
+quarter of the frame).  Returns for each the frames per second and the 
+fraction of frames where the keep/drop decision agrees with the whole frame
+model.
+"""
+def compare_tiles(frames, sampleThreshold=10, tile_size=32, fps=15):
+    h, w = frames[0].shape
+    roi = np.full((h, w), 255, dtype=np.uint8)
+    roi[h*3//4:] = 0
+    roi_fn = os.path.join(tempfile.mkdtemp(), "roi.png")
+    cv.imwrite(roi_fn, roi)
+
+    runs = [ ("whole frame", dict(in_place=True), None),
+             ("roi", dict(in_place=True, roi=roi_fn), None),
+             ("roi + tiles", dict(roi=roi_fn, tile_size=tile_size), None),
+             ("roi + tiles + early exit", dict(roi=roi_fn, tile_size=tile_size), sampleThreshold) ]
+    results = []
+    for name, kargs, stop_after in runs:
+        speed, counts = run_counts(PCH(**kargs), frames, fps, stop_after)
+        results.append((name, speed, counts > sampleThreshold))
+    shutil.rmtree(os.path.dirname(roi_fn))
+
+    reference = results[1][2]
+    return [ (name, speed, np.mean(keep == reference)) for name, speed, keep in results ]
+
+"""
+Filter the event maps of the frames with the contrib guided filter (when it is
+installed) and the one of guided.py, at full resolution and subsampled.  Returns
+for each the milliseconds per frame, the fraction of pixels that differ from
+the first one and the fraction of frames where the keep/drop decision agrees.
+"""
+def compare_guided(frames, sampleThreshold=10, subsamples=(2, 4), fps=15):
+    pch = PCH()
+    pch.initialize(frames[0].shape, fps)
+    maps = []
+    for prev, curr in zip(frames[:-1], frames[1:]):
+        pch.update_model(prev, curr)
+        maps.append((curr, np.uint8(pch.E_matrix)))
+
+    engines = []
+    if guided.contribGuidedFilter is not None:
+        engines.append(("cv2.ximgproc", guided.contribGuidedFilter))
+    engines.append(("guided.py", guided._guided_filter))
+    for s in subsamples:
+        engines.append(("guided.py 1/{}".format(s), 
+                        lambda I, p, r, eps, s=s: guided._guided_filter(I, p, r, eps, s)))
+
+    results = []
+    for name, fn in engines:
+        start = time.time()
+        filtered = [ fn(curr, E, 5, 0.1) for curr, E in maps ]
+        ms = 1000 * (time.time() - start) / len(maps)
+        results.append((name, ms, filtered))
+
+    reference = results[0][2]
+    keep = [ np.count_nonzero(q == PixelEvent.NEW_MOTION) > sampleThreshold for q in reference ]
+    return [ (name, ms, 
+              np.mean([ np.mean(q != r) for q, r in zip(filtered, reference) ]),
+              np.mean([ (np.count_nonzero(q == PixelEvent.NEW_MOTION) > sampleThreshold) == k 
+                        for q, k in zip(filtered, keep) ]))
+             for name, ms, filtered in results ]
+
+"""
+Write the underwater-like footage as a color video to `video_fn`
+"""
+def underwater_video(video_fn, nframes, fps=15, frame_size=(480,640), quiet=3):
+    import imageio
+    writer = imageio.get_writer(video_fn, fps=fps)
+    for frame in underwater_frames(nframes, frame_size, quiet=quiet):
+        writer.append_data(cv.cvtColor(frame, cv.COLOR_GRAY2RGB))
+    writer.close()
+
+"""
+Decode every frame of the video like `runVideo`
+"""
+def bench_decode(video_fn):
+    import imageio
+    import reduce_script
+
+    video = imageio.get_reader(video_fn, 'ffmpeg')
+    start = time.time()
+    nframes = sum(1 for _ in reduce_script.readFrames(video))
+    secs = time.time() - start
+    video.close()
+    return { "frames" : nframes, "secs" : secs, "fps" : nframes / secs }
+
+"""
+Analyse the sampled frames of the video with the model of `opts`.  The frames
+per second are of the analysed frames.
+"""
+def bench_analyse(video_fn, opts):
+    import imageio
+    import reduce_script
+
+    video = imageio.get_reader(video_fn, 'ffmpeg')
+    fps = video.get_meta_data()['fps']
+    frame_size = (608,800)
+    pch = reduce_script.createModel(opts)
+    pch.initialize(frame_size, fps)
+
+    stages = { "decode" : 0., "gray" : 0., "update_model" : 0. }
+    gray_prev = None
+    nframes = 0
+    start = time.time()
+    for frame_num in range(0, sys.maxsize, opts['samplingRate']):
+        mark = time.time()
+        try:
+            frame = video.get_data(frame_num)
+        except IndexError:
+            break
+        stages["decode"] += time.time() - mark
+
+        mark = time.time()
+        gray_curr = reduce_script.toGray(frame, frame_size)
+        stages["gray"] += time.time() - mark
+
+        mark = time.time()
+        pch.update_model(gray_curr if gray_prev is None else gray_prev, gray_curr)
+        stages["update_model"] += time.time() - mark
+        gray_prev = gray_curr
+        nframes += 1
+    secs = time.time() - start
+    video.close()
+    return { "frames" : nframes, "secs" : secs, "fps" : nframes / secs, "stages" : stages }
+
+"""
+Encode `nframes` frames of the video's size like the summary is written
+"""
+def bench_encode(video_fn, nframes):
+    import imageio
+
+    video = imageio.get_reader(video_fn, 'ffmpeg')
+    frame, fps = video.get_data(0), video.get_meta_data()['fps']
+    video.close()
+
+    out_fn = os.path.join(tempfile.mkdtemp(), "encoded.mp4")
+    writer = imageio.get_writer(out_fn, fps=fps)
+    start = time.time()
+    for _ in range(nframes):
+        writer.append_data(frame)
+    writer.close()
+    secs = time.time() - start
+    shutil.rmtree(os.path.dirname(out_fn))
+    return { "frames" : nframes, "secs" : secs, "fps" : nframes / secs }
+
+"""
+Summarize the video with `runVideo`.  The frames per second are of the
+original video.  The stage statistics of the run (`stats`) are also
+added.
+"""
+def bench_summarize(video_fn, nframes, opts):
+    import reduce_script
+
+    out_dir = tempfile.mkdtemp()
+    start = time.time()
+    reduce_script.runVideo(video_fn, os.path.join(out_dir, "summary.mp4"), 
+                           dict(opts, stats=1))
+    secs = time.time() - start
+    shutil.rmtree(out_dir)
+    return { "frames" : nframes, "secs" : secs, "fps" : nframes / secs, 
+             "stages" : utils.stats.report()["stages"] }
+
+"""
+The version of the code and the libraries the report was made with
+"""
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                universal_newlines=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return { "time" : time.strftime("%Y-%m-%dT%H:%M:%S"), "commit" : commit,
+             "machine" : platform.machine(), "cpus" : os.cpu_count(),
+             "versions" : { "python" : platform.python_version(),
+                            "numpy"  : np.__version__,
+                            "opencv" : cv.__version__ } }
+
+"""
+Run every case of the suite on a synthetic video of `nframes` frames and
+return the report
+"""
+def suite(nframes, opts):
+    video_fn = os.path.join(tempfile.mkdtemp(), "synthetic.mp4")
+    underwater_video(video_fn, nframes)
+
+    cases = [ ("decode", bench_decode, (video_fn,)),
+              ("analyse", bench_analyse, (video_fn, opts)),
+              ("encode", bench_encode, (video_fn, nframes)),
+              ("summarize encode", bench_summarize, 
+                    (video_fn, nframes, dict(opts, output="encode"))),
+              ("summarize segments", bench_summarize, 
+                    (video_fn, nframes, dict(opts, output="segments"))) ]
+    results = []
+    for name, fn, args in cases:
+        result, peak = utils.run_isolated(fn, *args)
+        result.update(name=name, peak_mb=peak)
+        results.append(result)
+    shutil.rmtree(os.path.dirname(video_fn))
+
+    return dict(environment(), benchmark="summarize", opts=opts, cases=results)
+
+"""
+The commands of the benchmark, called with the summarize params and the
+arguments after the command name
+"""
+def run_suite(opts, args):
+    nframes = int(args[0]) if args else 600
+    report = suite(nframes, opts)
+    if len(args) > 1:
+        with open(args[1], "w") as f:
+            json.dump(report, f, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
+
+def run_pyramid(opts, args):
+    nframes = int(args[0]) if args else 240
+    frames = underwater_frames(nframes, quiet=3)
+    for name, speed, screened, agreement in compare_pyramid(frames, opts["sampleThreshold"]):
+        print("{:16s}: {:8.2f} frames/sec, {:7.2%} screened out, {:7.2%} decisions agree".format(
+                    name, speed, screened, agreement))
+
+def run_guided(opts, args):
+    nframes = int(args[0]) if args else 100
+    for name, ms, differ, agreement in compare_guided(underwater_frames(nframes), 
+                                                      opts["sampleThreshold"]):
+        print("{:16s}: {:7.2f} ms/frame, {:7.3%} pixels differ, {:7.2%} decisions agree".format(
+                    name, ms, differ, agreement))
+
+def run_tiles(opts, args):
+    nframes = int(args[0]) if args else 200
+    for name, speed, agreement in compare_tiles(underwater_frames(nframes), 
+                                                opts["sampleThreshold"]):
+        print("{:24s}: {:8.2f} frames/sec, {:7.2%} decisions agree with roi".format(
+                    name, speed, agreement))
+
+def run_backgrounds(opts, args):
+    nframes = int(args[0]) if args else 200
+    for name, (speed, agreement) in compare_backgrounds(underwater_frames(nframes),
+                                                        opts["sampleThreshold"]).items():
+        print("{:8s}: {:8.2f} frames/sec, {:7.2%} decisions agree with mog".format(
+                    name, speed, agreement))
+
+def run_sampling(opts, args):
+    nframes = int(args[0]) if args else 300 * opts['samplingRate']
+    video_fn = os.path.join(tempfile.mkdtemp(), "synthetic.mp4")
+    fps, quiet = 15, 5
+    synthetic_video(video_fn, nframes, fps, quiet=quiet)
+    events = set(i for i in range(nframes) if (i // (4*fps)) % (quiet + 1) == 0)
+    for name, (analysed, kept, recall) in zip(("fixed", "adaptive"), 
+                                              adaptive_sampling(video_fn, opts, events)):
+        print("{:8s}: {:6d} frames analysed, {:6d} kept, {:7.2%} of the event frames kept".format(
+                    name, analysed, kept, recall))
+    shutil.rmtree(os.path.dirname(video_fn))
+
+def run_cuts(opts, args):
+    nframes = min(max(int(args[0]) if args else 300, 230), 1024)
+    #Segments that start and end between keyframes, on a keyframe, at the ends
+    #of the video, and one inside a GOP
+    segments = [ (0, 10), (40, 75), (100, 111), (200, 215), (nframes - 10, nframes) ]
+    for name, (exact, n, fps) in zip(("copy", "boundaryReencode"), check_cuts(nframes, segments)):
+        print("{:16s}: {:4d} frames, {:6.2f} fps, {}".format(
+                    name, n, fps, "frames right" if exact else "WRONG FRAMES"))
+
+#Without a command: [nframes] [shards]
+def run_engines(opts, args):
+    nframes = int(args[0]) if args else 20
+    frames = synthetic_frames(nframes)
+
+    before = PCH()
+    use_per_pixel_functions(before)
+    fps_before, events_before = run(before, frames)
+
+    fps_after, events_after = run(PCH(), frames)
+    fps_in_place, events_in_place = run(PCH(in_place=True), frames)
+    fps_batch, _ = run_batch(PCH(), frames)
+
+    mismatched = sum(np.count_nonzero(a != b) for a,b in zip(events_before, events_after))
+    print("per pixel (np.vectorize): {:8.2f} frames/sec".format(fps_before))
+    print("array-native            : {:8.2f} frames/sec".format(fps_after))
+    print("array-native (in place) : {:8.2f} frames/sec".format(fps_in_place))
+    print("array-native (batched)  : {:8.2f} frames/sec".format(fps_batch))
+    print("speedup                 : {:8.2f}x".format(fps_after / fps_before))
+    print("mismatched labels       : {} of {}".format(
+                mismatched, sum(e.size for e in events_after)))
+    print("mismatched (in place)   : {}".format(
+                sum(np.count_nonzero(a != b) for a,b in zip(events_after, events_in_place))))
+    print("mismatched (batch, roi) : {}".format(batch_roi_mismatch(frames)))
+    #Tiled models only give the ROI's bounding box to the GMM, every tile is 
+    #analysed with a negative floor
+    print("mismatched (batch, roi, tiles): {}".format(
+                batch_roi_mismatch(frames, tile_size=32, tile_floor=-1)))
+
+    if len(args) > 1:
+        shards = int(args[1])
+        video_fn = os.path.join(tempfile.mkdtemp(), "synthetic.mp4")
+        synthetic_video(video_fn, 150 * opts['samplingRate'])
+        print("shard disagreement      : {:8.2%} ({} shards)".format(
+                    shard_disagreement(video_fn, opts, shards), shards))
+        os.remove(video_fn)
+        os.rmdir(os.path.dirname(video_fn))
+
+COMMANDS = { "suite"       : run_suite,
+             "pyramid"     : run_pyramid,
+             "guided"      : run_guided,
+             "cuts"        : run_cuts,
+             "tiles"       : run_tiles,
+             "backgrounds" : run_backgrounds,
+             "sampling"    : run_sampling }
+
+def main(argv):
+    with open("params.json", "r") as f:
+        opts = json.load(f)["summarize"]
+    if len(argv) > 1 and argv[1] in COMMANDS:
+        COMMANDS[argv[1]](opts, argv[2:])
+    else:
+        run_engines(opts, argv[1:])
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,131 @@
+"""
+Guided filter (He et al.) built on box filters, so the refinement doesn't need
+the `cv2.ximgproc` module of opencv-contrib.  It gives the same results as
+`cv2.ximgproc.guidedFilter` with a gray guide: the guide isn't rescaled, the
+borders are reflected and the result has the type of the filtered image
+(rounded for integers).
+
+The box filters (the mean of every (2r+1)x(2r+1) window) use OpenCV when it is
+installed, otherwise integral images in NumPy, so the cost doesn't depend on
+the radius.  When opencv-contrib is installed its filter, which gives the same
+results, is used at full resolution since it is faster.
+
+With `subsample` the coefficients of the filter are computed on an image 
+`subsample` times smaller (the mean of every block) and upsampled with the
+pixel centers aligned, He's "fast guided filter", which is about 
+`subsample`^2 times less work for a slightly smoother result.  Crops of an
+image that start on a multiple of `subsample` and have a margin of 
+2*radius + 2*subsample pixels are filtered like the whole image.
+
+The same module is in the summarize and dehaze folders.
+"""
+
+import numpy as np
+
+try:
+    import cv2 as cv
+except ImportError:
+    cv = None
+try:
+    from cv2.ximgproc import guidedFilter as contribGuidedFilter
+except ImportError:
+    contribGuidedFilter = None
+
+"""
+Mean of the (2r+1)x(2r+1) window around every pixel of a float32 image, the
+borders reflected (abc|cba)
+"""
+def box_filter(img, radius):
+    if cv is not None:
+        size = 2 * radius + 1
+        return cv.boxFilter(img, -1, (size, size), borderType=cv.BORDER_REFLECT)
+
+    #Window sums are differences of the integral image, in float64 so the
+    #differences of large sums stay exact enough
+    size = 2 * radius + 1
+    padded = np.pad(img, radius, mode="symmetric")
+    integral = np.zeros((padded.shape[0] + 1, padded.shape[1] + 1), dtype=np.float64)
+    np.cumsum(np.cumsum(padded, axis=0, dtype=np.float64), axis=1, out=integral[1:,1:])
+    h, w = img.shape
+    sums = integral[size:size+h, size:size+w] - integral[:h, size:size+w] \
+           - integral[size:size+h, :w] + integral[:h, :w]
+    return (sums / size ** 2).astype(np.float32)
+
+"""
+Mean of the `s`x`s` blocks of a float32 image whose sides are multiples of
+`s`, so every small pixel is centered on the block it covers
+"""
+def _downsample(img, s):
+    h, w = img.shape
+    if cv is not None:
+        return cv.resize(img, (w // s, h // s), interpolation=cv.INTER_AREA)
+    return img.reshape(h // s, s, w // s, s).mean(axis=(1,3))
+
+"""
+Bilinear resize of a float32 image to `shape` (height, width), with the pixel
+centers aligned like OpenCV
+"""
+def _resize(img, shape):
+    if cv is not None:
+        return cv.resize(img, (shape[1], shape[0]), interpolation=cv.INTER_LINEAR)
+    for axis, n in enumerate(shape):
+        m = img.shape[axis]
+        pos = np.clip((np.arange(n) + 0.5) * m / n - 0.5, 0, m - 1)
+        i0 = np.floor(pos).astype(np.intp)
+        i1 = np.minimum(i0 + 1, m - 1)
+        weight = (pos - i0).astype(np.float32)
+        weight = weight.reshape((-1, 1) if axis == 0 else (1, -1))
+        img = np.take(img, i0, axis=axis) * (1 - weight) + np.take(img, i1, axis=axis) * weight
+    return img
+
+"""
+Filter `src` (uint8 or float32, one channel) with the edges of `guide` (one
+channel).  `eps` is the regularization in the units of the guide squared.
+The result is written to `dst` if it is given.  Without `subsample` the
+opencv-contrib filter is used when it is installed.
+"""
+def guided_filter(guide, src, radius, eps, subsample=1, dst=None):
+    if subsample <= 1 and contribGuidedFilter is not None:
+        return contribGuidedFilter(guide, src, radius, eps, dst=dst)
+    return _guided_filter(guide, src, radius, eps, subsample, dst)
+
+def _guided_filter(guide, src, radius, eps, subsample=1, dst=None):
+    I = guide.astype(np.float32, copy=False)
+    p = src.astype(np.float32, copy=False)
+    if src.ndim == 3:
+        p = p[:,:,0]
+
+    #The coefficients a, b of q = a I + b are computed on a smaller image.
+    #The sides are padded to whole blocks of `subsample` pixels from the top
+    #left corner, so crops starting on a multiple of `subsample` use the same
+    #blocks as the whole image.
+    I_small, p_small, r = I, p, radius
+    if subsample > 1:
+        h, w = I.shape
+        if h % subsample or w % subsample:
+            pad = ((0, -h % subsample), (0, -w % subsample))
+            I, p = np.pad(I, pad, mode="symmetric"), np.pad(p, pad, mode="symmetric")
+        I_small, p_small = _downsample(I, subsample), _downsample(p, subsample)
+        r = max(radius // subsample, 1)
+
+    mean_I = box_filter(I_small, r)
+    mean_p = box_filter(p_small, r)
+    var_I = box_filter(I_small * I_small, r) - mean_I * mean_I
+    cov_Ip = box_filter(I_small * p_small, r) - mean_I * mean_p
+    a = cov_Ip / (var_I + eps)
+    b = mean_p - a * mean_I
+    mean_a = box_filter(a, r)
+    mean_b = box_filter(b, r)
+    if subsample > 1:
+        mean_a = _resize(mean_a, I.shape)
+        mean_b = _resize(mean_b, I.shape)
+
+    q = mean_a * I + mean_b
+    if q.shape != src.shape[:2]:
+        q = q[:src.shape[0], :src.shape[1]]
+    if src.dtype == np.uint8:
+        q = np.clip(np.rint(q), 0, 255)
+    if dst is None:
+        return q.astype(src.dtype, copy=False)
+    np.copyto(dst.reshape(q.shape), q, casting="unsafe")
+    return dst
@@ -0,0 +1,115 @@
+"""
+Per frame novelty index of a summarized video.  For every analysed frame it
+keeps the frame number, timestamp, number of high (new motion) and medium (old
+motion) novelty events and optionally a coarse grid of where the new motion
+is.  Each column is saved in its own .npy file so it can be memory mapped,
+and the summary can be made again with other thresholds without analysing
+the video again.
+"""
+
+import json
+import os
+import numpy as np
+
+from pch import PixelEvent
+
+COLUMNS = ("frame", "time", "new_motion", "old_motion", "histogram")
+
+"""
+Count the new and old motion events of an event map (as returned by
+`PCH.update_model`).  With a `grid`, also return the number of new motion
+events in each of the grid x grid tiles of the frame.
+"""
+def countEvents(result, grid=0):
+    new = result == PixelEvent.NEW_MOTION
+    new_motion = np.count_nonzero(new)
+    old_motion = np.count_nonzero(result >= PixelEvent.OLD_MOTION) - new_motion
+
+    histogram = None
+    if grid:
+        h, w = new.shape
+        h, w = h - h % grid, w - w % grid
+        histogram = new[:h,:w].reshape(grid, h // grid, grid, w // grid) \
+                              .sum(axis=(1,3)).astype(np.uint16)
+    return new_motion, old_motion, histogram
+
+"""
+Collects the novelty of the analysed frames and saves them in `index_dir`
+"""
+class IndexWriter(object):
+    def __init__(self, index_dir, video_fn, fps, samplingRate):
+        self._index_dir = index_dir
+        self._meta = { "video"        : os.path.relpath(os.path.abspath(video_fn),
+                                                        os.path.abspath(index_dir)),
+                       "fps"          : fps,
+                       "samplingRate" : samplingRate }
+        self._rows = []
+
+    def append(self, frame_num, new_motion, old_motion, histogram=None):
+        self._rows.append((frame_num, new_motion, old_motion, histogram))
+
+    #Add the rows of columns returned by `columns`, used to resume an index
+    def extend(self, columns):
+        histograms = columns.get("histogram", [None] * len(columns["frame"]))
+        for row in zip(columns["frame"], columns["new_motion"], 
+                       columns["old_motion"], histograms):
+            self.append(*row)
+
+    #The rows collected so far as columns (without the time)
+    def columns(self):
+        self._rows.sort(key=lambda row: row[0])
+        frames = np.array([ row[0] for row in self._rows ], dtype=np.int64)
+        columns = {
+            "frame"      : frames,
+            "new_motion" : np.array([ row[1] for row in self._rows ], dtype=np.uint32),
+            "old_motion" : np.array([ row[2] for row in self._rows ], dtype=np.uint32),
+        }
+        if self._rows and self._rows[0][3] is not None:
+            columns["histogram"] = np.stack([ row[3] for row in self._rows ])
+        return columns
+
+    def close(self):
+        columns = self.columns()
+        columns["time"] = columns["frame"] / float(self._meta["fps"])
+
+        if not os.path.isdir(self._index_dir):
+            os.makedirs(self._index_dir)
+        for name, column in columns.items():
+            np.save(os.path.join(self._index_dir, name + ".npy"), column)
+        with open(os.path.join(self._index_dir, "meta.json"), "w") as f:
+            json.dump(self._meta, f, indent=4)
+
+"""
+Load an index, returns the meta data (with the path to the video) and the
+memory mapped columns
+"""
+def loadIndex(index_dir):
+    with open(os.path.join(index_dir, "meta.json"), "r") as f:
+        meta = json.load(f)
+    meta["video"] = os.path.normpath(os.path.join(index_dir, meta["video"]))
+
+    columns = {}
+    for name in COLUMNS:
+        fn = os.path.join(index_dir, name + ".npy")
+        if os.path.isfile(fn):
+            columns[name] = np.load(fn, mmap_mode="r")
+    return meta, columns
+
+"""
+Return the analysed frames that would be kept with `sampleThreshold`.  With a
+`stride` only every stride-th analysed frame is considered, as if the video
+had been sampled `stride` times less often.
+"""
+def keptFrames(columns, sampleThreshold, stride=1):
+    frames = columns["frame"][::stride]
+    return frames[columns["new_motion"][::stride] > sampleThreshold].tolist()
+
+"""
+Return the number of frames between each frame `keptFrames` keeps and the
+frame considered before it, which it stands for.  The first frame stands for
+`samplingRate` * `stride` frames.  Works for fixed and adaptive sampling.
+"""
+def keptStrides(columns, sampleThreshold, samplingRate, stride=1):
+    frames = np.asarray(columns["frame"][::stride], dtype=np.int64)
+    gaps = np.diff(np.concatenate((frames[:1] - samplingRate * stride, frames)))
+    return gaps[columns["new_motion"][::stride] > sampleThreshold].tolist()
@@ -5,8 +5,14 @@ through pixel intensity changes
 """
 
 import cv2 as cv
-from cv2.ximgproc import guidedFilter
 import numpy as np
+import os
+
+from collections import deque
+
+import backgrounds
+from guided import guided_filter
+from utils import stats
 
 """
 Helper enum class: 
@@ -34,6 +40,29 @@ class PCH(object):
         #This does not currently work in the sandbox but can be used to improve speed of
         #of local testing if CUDA/numba is installed
         self._use_gpu         = kargs.pop("use_gpu", False)
+
+        #Preallocate the working matrices in `initialize` and update them in
+        #place so long videos don't allocate new frames for every update
+        self._in_place        = kargs.pop("in_place", False)
+
+        #The background model that finds the foreground pixels, see backgrounds.py
+        self._background      = kargs.pop("background", "mog")
+        if self._background not in backgrounds.BACKENDS:
+            raise ValueError("'{}' is not a background model, use one of {}".format(
+                                self._background, ", ".join(backgrounds.BACKENDS)))
+
+        #An image of the camera's region of interest (non zero pixels), events
+        #outside of it are dropped.  Housing, rocks, lasers...
+        self._roi             = kargs.pop("roi", "")
+
+        #Split the frame in tiles of `tile_size` pixels and skip the tiles where
+        #the mean frame difference is below `tile_floor`, 0 to disable
+        self._tile_size       = kargs.pop("tile_size", 0)
+        self._tile_floor      = kargs.pop("tile_floor", 4.)
+
+        #Compute the guided filter that smooths the events on a frame this many
+        #times smaller (the fast guided filter), 1 for the full resolution
+        self._filter_subsample = kargs.pop("filter_subsample", 1)
         
 
         if kargs:
@@ -61,8 +90,10 @@ class PCH(object):
 
             self.adjust = adjust
         else:
-            self.activation = np.vectorize(self._activation)
-            self.adjust = np.vectorize(self._adjust)
+            #The CPU functions operate on whole matrices at once, so there is
+            #no per pixel python call
+            self.activation = self._activation
+            self.adjust = self._adjust
         
     #Setters/Getters for matrices
     @property
@@ -103,58 +134,274 @@ class PCH(object):
         else:
             self.__E_matrix = el
    
-    #This is the GMM background model. Underwater this is very noisy so 
-    #we can't use it "as-is".
+    #This is the GMM (or other) background model. Underwater this is very 
+    #noisy so we can't use it "as-is".
     @property
     def foreground(self):
         if self.__foreground is None:
-            self.__foreground = cv.bgsegm.createBackgroundSubtractorMOG(
-                                    history=self._gmmHistory 
-                                    )
+            self.__foreground = backgrounds.create(self._background, 
+                                                   self._gmmHistory)
         return self.__foreground
     @foreground.setter
     def foreground(self,x):
         self.__foreground = x 
    
     #This functions controls how fast/slow the probability a pixel is novel
-    #based on it's history.
+    #based on it's history.  Works on scalars and (float32) matrices alike.
     def _adjust(self, t):
         return -2.*t*t*t + 3.*t*t
 
     #This function sets a pixel as novel/kinda novel/or not novel based on 
-    #threshold values.
+    #threshold values.  The difference is taken in int16 so it does not
+    #wrap around for the int8 frames.
     def _activation(self, a,b,c):
-        return 0 if c < self._T_H \
-                 else PixelEvent.NEW_MOTION \
-                 if abs(a-b) > self._T_M \
-                 else \
-                 PixelEvent.OLD_MOTION
-
-    #Update the current model state
-    def update_model(self, frame_prev, frame_curr):
+        diff = np.abs(np.subtract(a, b, dtype=np.int16))
+        return np.where(c < self._T_H, 0,
+                 np.where(diff > self._T_M,
+                          PixelEvent.NEW_MOTION,
+                          PixelEvent.OLD_MOTION)).astype(np.uint8)
+
+    #Update the current model state.  When only the keep/drop decision is 
+    #needed, `stop_after` lets the tiled mode stop once that many high 
+    #novelty events are found (the event map is then incomplete).
+    def update_model(self, frame_prev, frame_curr, stop_after=None):
+        if self._tile_size and not self._use_gpu:
+            result = self._update_model_tiled(frame_prev, frame_curr, stop_after)
+        elif self._in_place and not self._use_gpu:
+            result = self._update_model_in_place(frame_prev, frame_curr)
+        else:
+            result = self._update_model(frame_prev, frame_curr)
+
+        if self._roi_outside is not None:
+            np.copyto(result, 0, where=self._roi_outside)
+        return result
+
+    def _update_model(self, frame_prev, frame_curr):
+
         self.E_matrix[:] = 0 
 
         #The GMM will give 255 for foreground pixels and 0 for background.
         #Foreground pixels increase, and background decrease by a set factor
-        self.D_matrix = self.foreground.apply(
-                                frame_curr,
-                                self.D_matrix, 
-                                learningRate=self._learningRate) 
-        D = self.D_matrix.copy().astype("float32")
-        D = D / 255 * self._accum_factor 
-        D[D == 0] = -self._decay_factor
-      
-        #We add the latest evolution to our time matrix T and ensure
-        #that we remain in the range [0,1] to ensure math. stability
-        self.T_matrix = np.add(D, self.T_matrix)
-        self.T_matrix = np.clip(self.T_matrix, 0, 1)
-
-        #Calculate the probability of each pixel and run the activation function to label the pixels
-        self.P_matrix = self.adjust(self.T_matrix) * 255
-        self.E_matrix = self.activation(np.int8(frame_prev), np.int8(frame_curr), self.P_matrix)
+        with stats.stage("bg_model"):
+            self.D_matrix = self.foreground.apply(
+                                    frame_curr,
+                                    self.D_matrix, 
+                                    learningRate=self._learningRate) 
+        with stats.stage("activation"):
+            D = self.D_matrix.copy().astype("float32")
+            D = D / 255 * self._accum_factor 
+            D[D == 0] = -self._decay_factor
+          
+            #We add the latest evolution to our time matrix T and ensure
+            #that we remain in the range [0,1] to ensure math. stability
+            self.T_matrix = np.add(D, self.T_matrix)
+            self.T_matrix = np.clip(self.T_matrix, 0, 1)
+
+            #Calculate the probability of each pixel and run the activation function to label the pixels
+            self.P_matrix = self.adjust(self.T_matrix) * 255
+            self.E_matrix = self.activation(np.int8(frame_prev), np.int8(frame_curr), self.P_matrix)
    
-        return guidedFilter(frame_curr, np.uint8(self.E_matrix), 5, 0.1)
-       
+        with stats.stage("guided_filter"):
+            return guided_filter(frame_curr, np.uint8(self.E_matrix), 5, 0.1, 
+                                 self._filter_subsample)
+
+    #Update the model with a stack of consecutive frames (N,H,W) that follow 
+    #`frame_prev`.  This gives the same result as calling `update_model` on
+    #each pair of frames, but everything except the GMM, the T matrix recurrence
+    #and the guided filter is done on the whole stack at once.  Returns the
+    #(N,H,W) event maps, or the number of high novelty (255) events per frame 
+    #if `counts` is set.
+    def update_model_batch(self, frame_prev, frames, counts=False):
+        frames = np.asarray(frames)
+        n = len(frames)
+
+        #The GMM and T matrix depend on the previous frame so they're sequential.
+        #In the tiled mode the GMM only sees the ROI's bounding box.
+        box = self._roi_box if self._tile_size else np.s_[:,:]
+        D_stack = np.empty((n,) + frames[0][box].shape, dtype="uint8")
+        with stats.stage("bg_model"):
+            for i in range(n):
+                D_stack[i] = self.foreground.apply(
+                                    frames[i][box],
+                                    D_stack[i],
+                                    learningRate=self._learningRate)
+        with stats.stage("activation"):
+            D = np.full(frames.shape, -self._decay_factor, dtype="float32")
+            D[(slice(None),) + box] = np.where(D_stack == 0, -self._decay_factor,
+                                               D_stack / 255. * self._accum_factor)
+
+            T = self.T_matrix
+            for i in range(n):
+                np.add(D[i], T, out=D[i])
+                np.clip(D[i], 0, 1, out=D[i])
+                T = D[i]
+        
+            P = self.adjust(D) * 255
+            frames_prev = np.concatenate((frame_prev[np.newaxis], frames[:-1]))
+            E = np.uint8(self.activation(np.int8(frames_prev), np.int8(frames), P))
+
+            #Keep the model state as if the frames were updated one at a time
+            if self.D_matrix is None:
+                self.D_matrix = D_stack[-1].copy()
+            else:
+                np.copyto(self.D_matrix, D_stack[-1])
+            np.copyto(self.T_matrix, D[-1])
+            np.copyto(self.P_matrix, P[-1])
+            np.copyto(self.E_matrix, E[-1])
+
+        with stats.stage("guided_filter"):
+            for i in range(n):
+                guided_filter(frames[i], E[i], 5, 0.1, self._filter_subsample, dst=E[i])
+        if self._roi_outside is not None:
+            E[:, self._roi_outside] = 0
+
+        if counts:
+            return np.count_nonzero(E == PixelEvent.NEW_MOTION, axis=(1,2))
+        return E
+
+    #Same as `update_model` but all the work is done in the buffers allocated
+    #by `initialize`.  The returned event map is also a buffer, so it is only 
+    #valid until the next update.
+    def _update_model_in_place(self, frame_prev, frame_curr):
+        D, M, diff = self._D_buffer, self._mask_buffer, self._diff_buffer
+        T, P, E = self.T_matrix, self.P_matrix, self.E_matrix
+
+        with stats.stage("bg_model"):
+            self.foreground.apply(frame_curr, self.D_matrix, 
+                                  learningRate=self._learningRate)
+        with stats.stage("activation"):
+            np.divide(self.D_matrix, 255, out=D, dtype=np.float32)
+            np.multiply(D, self._accum_factor, out=D, dtype=np.float32)
+            np.equal(D, 0, out=M)
+            np.copyto(D, -self._decay_factor, where=M)
+
+            np.add(D, T, out=T)
+            np.clip(T, 0, 1, out=T)
+
+            #P = adjust(T) * 255, D is free to use as scratch now
+            np.multiply(T, -2., out=D, dtype=np.float32)
+            np.multiply(D, T, out=D)
+            np.multiply(D, T, out=D)
+            np.multiply(T, 3., out=P, dtype=np.float32)
+            np.multiply(P, T, out=P)
+            np.add(D, P, out=P)
+            np.multiply(P, 255, out=P, dtype=np.float32)
+
+            #activation, the uint8 frames are viewed as int8 like np.int8() would do
+            np.subtract(frame_prev.view(np.int8), frame_curr.view(np.int8), 
+                        out=diff, dtype=np.int16)
+            np.abs(diff, out=diff)
+            np.greater(diff, self._T_M, out=M)
+            E.fill(PixelEvent.OLD_MOTION)
+            np.copyto(E, PixelEvent.NEW_MOTION, where=M)
+            np.less(P, self._T_H, out=M)
+            np.copyto(E, 0, where=M)
+
+        with stats.stage("guided_filter"):
+            return guided_filter(frame_curr, E, 5, 0.1, self._filter_subsample, 
+                                 dst=self._G_buffer)
+
+    #Same as `update_model` but the activation and guided filter are only done
+    #for the tiles of the frame where the mean frame difference is above the
+    #floor (and that are in the ROI), the other tiles have no events.  The GMM
+    #needs to see every frame to learn the background, so it still sees the 
+    #whole ROI.  The guided filter is done on the busiest tiles first so it 
+    #can stop after `stop_after` events.
+    def _update_model_tiled(self, frame_prev, frame_curr, stop_after=None):
+        t, (h, w) = self._tile_size, self._frame_size
+        T, P, E, D = self.T_matrix, self.P_matrix, self.E_matrix, self._D_buffer
+        result = self._G_buffer
+
+        #Mean absolute difference of every tile, padded to whole tiles
+        diff = self._diff_tiles
+        diff[:h,:w] = cv.absdiff(frame_prev, frame_curr)
+        ny, nx = self._tiles.shape
+        energy = diff.reshape(ny, t, nx, t).mean(axis=(1,3))
+        active = (energy > self._tile_floor) & self._tiles
+        busiest = sorted(zip(*np.nonzero(active)), key=lambda yx: -energy[yx])
+        self.tiles_analysed = len(busiest)
+        stats.count("tiles_analysed", len(busiest))
+
+        with stats.stage("bg_model"):
+            box = self._roi_box
+            self.D_matrix = self.foreground.apply(frame_curr[box], self.D_matrix,
+                                                  learningRate=self._learningRate)
+        with stats.stage("activation"):
+            D.fill(-self._decay_factor)
+            D[box] = np.where(self.D_matrix == 0, -self._decay_factor, 
+                              self.D_matrix / 255. * self._accum_factor)
+            np.add(D, T, out=T)
+            np.clip(T, 0, 1, out=T)
+
+            E.fill(0)
+            for y, x in busiest:
+                tile = np.s_[y*t:(y+1)*t, x*t:(x+1)*t]
+                P[tile] = self.adjust(T[tile]) * 255
+                E[tile] = self.activation(np.int8(frame_prev[tile]), 
+                                          np.int8(frame_curr[tile]), P[tile])
+            if self._roi_outside is not None:
+                np.copyto(E, 0, where=self._roi_outside)
+
+        with stats.stage("guided_filter"):
+            #The guided filter of a tile needs the events around it, 2*radius
+            #(and 2*subsample, with the crop starting on a multiple of it so
+            #the subsampled filter uses the same blocks as the whole frame)
+            result.fill(0)
+            s = self._filter_subsample
+            events, halo = 0, 2 * 5 + (2 * s if s > 1 else 0)
+            for y, x in busiest:
+                y0, x0 = y*t, x*t
+                y1, x1 = min(y0 + t, h), min(x0 + t, w)
+                a0, b0 = max(y0 - halo, 0) // s * s, max(x0 - halo, 0) // s * s
+                around = np.s_[a0:y1 + halo, b0:x1 + halo]
+                filtered = guided_filter(frame_curr[around], E[around], 5, 0.1, s)
+                tile = filtered[y0 - a0:y1 - a0, x0 - b0:x1 - b0]
+                result[y0:y1, x0:x1] = tile
+                if stop_after is not None:
+                    new = tile == PixelEvent.NEW_MOTION
+                    if self._roi_outside is not None:
+                        new &= ~self._roi_outside[y0:y1, x0:x1]
+                    events += np.count_nonzero(new)
+                    if events > stop_after:
+                        break
+        return result
+
+    #Feed a frame to the GMM only, without changing the other matrices. The 
+    #OpenCV GMM can't be saved so it is warmed up again after loading a 
+    #checkpoint
+    def warm_up(self, frame):
+        if self._tile_size:
+            frame = frame[self._roi_box]
+        self.D_matrix = self.foreground.apply(frame, self.D_matrix,
+                                              learningRate=self._learningRate)
+
+    #Save the model matrices (and any `extra` arrays, like the last frame) to a
+    #compressed checkpoint.  The file is replaced at once so a job killed while
+    #saving still has the previous checkpoint.
+    def save_checkpoint(self, fn, **extra):
+        state = { "T_matrix" : self.T_matrix,
+                  "P_matrix" : self.P_matrix,
+                  "E_matrix" : self.E_matrix }
+        if self.D_matrix is not None:
+            state["D_matrix"] = self.D_matrix
+        with open(fn + ".tmp", "wb") as f:
+            np.savez_compressed(f, **dict(extra, **state))
+        os.replace(fn + ".tmp", fn)
+
+    #Load the model matrices saved by `save_checkpoint` and return the extra
+    #arrays.  The model must be initialized with the same frame size.
+    def load_checkpoint(self, fn):
+        with np.load(fn) as checkpoint:
+            state = { name : checkpoint[name] for name in checkpoint.files }
+        np.copyto(self.T_matrix, state.pop("T_matrix"))
+        np.copyto(self.P_matrix, state.pop("P_matrix"))
+        np.copyto(self.E_matrix, state.pop("E_matrix"))
+        if "D_matrix" in state:
+            if self.D_matrix is None:
+                self.D_matrix = state.pop("D_matrix")
+            else:
+                np.copyto(self.D_matrix, state.pop("D_matrix"))
+        return state
 
     #Initialization function
     def initialize(self, frame_size, fps):
@@ -169,4 +416,112 @@ class PCH(object):
         self.P_matrix = frame_size 
         self.E_matrix = frame_size 
         self.T_matrix = frame_size
+
+        if self._in_place:
+            self.D_matrix       = np.zeros(frame_size, dtype="uint8")
+            self._D_buffer      = np.zeros(frame_size, dtype="float32")
+            self._diff_buffer   = np.zeros(frame_size, dtype="int16")
+            self._mask_buffer   = np.zeros(frame_size, dtype="bool")
+            self._G_buffer      = np.zeros(frame_size, dtype="uint8")
+
+        self._roi_outside = None
+        if self._roi:
+            roi = cv.imread(self._roi, cv.IMREAD_GRAYSCALE)
+            if roi is None:
+                raise IOError("Can't read the ROI mask '{}'".format(self._roi))
+            roi = cv.resize(roi, (frame_size[1], frame_size[0]), 
+                            interpolation=cv.INTER_NEAREST)
+            self._roi_outside = roi == 0
+
+        #The tiled mode only gives the ROI's bounding box to the GMM
+        self._roi_box = np.s_[:,:]
+        if self._roi_outside is not None and not self._roi_outside.all():
+            ys, xs = np.nonzero(~self._roi_outside)
+            self._roi_box = np.s_[ys.min():ys.max()+1, xs.min():xs.max()+1]
+
+        if self._tile_size:
+            t, (h, w) = self._tile_size, frame_size
+            ny, nx = -(-h // t), -(-w // t)
+            #The tiles with some of the ROI in them
+            self._tiles = np.ones((ny, nx), dtype="bool")
+            if self._roi_outside is not None:
+                inside = np.zeros((ny*t, nx*t), dtype="bool")
+                inside[:h,:w] = ~self._roi_outside
+                self._tiles = inside.reshape(ny, t, nx, t).any(axis=(1,3))
+            self._diff_tiles    = np.zeros((ny*t, nx*t), dtype="uint8")
+            self._D_buffer      = np.zeros(frame_size, dtype="float32")
+            self._G_buffer      = np.zeros(frame_size, dtype="uint8")
+            self.tiles_analysed = 0
     
+
+"""
+Coarse to fine analysis: every frame is first analysed by a PCH at 1/`scale`
+of the resolution.  Only the frames where it finds more than `threshold` high
+novelty events (counted at the full resolution) are analysed again by a full
+resolution PCH, the others get the coarse event map resized to the full
+resolution.  The background model needs to see a run of frames, so when the
+full resolution PCH is needed again it starts over from the last `replay`
+frames that were only analysed coarsely (by default, one GMM history).
+"""
+class PyramidPCH(object):
+    def __init__(self, scale=4, threshold=0, replay=None, **kargs):
+        self._scale = scale
+        self._threshold = threshold
+        self._replay = replay
+        #The tiles are sized for the full resolution
+        self.coarse = PCH(**dict(kargs, tile_size=0))
+        self.fine = PCH(**kargs)
+
+    def _downscale(self, frame):
+        h, w = self._coarse_size
+        return cv.resize(frame, (w, h), interpolation=cv.INTER_AREA)
+
+    def update_model(self, frame_prev, frame_curr, stop_after=None):
+        with stats.stage("coarse"):
+            coarse = self.coarse.update_model(self._downscale(frame_prev), 
+                                              self._downscale(frame_curr))
+        #At this size the guided filter blurs small objects away, so the
+        #events are counted before it
+        events = np.count_nonzero(self.coarse.E_matrix == PixelEvent.NEW_MOTION) \
+                 * self._scale ** 2
+        if events <= self._threshold:
+            self._awake = False
+            self._recent.append(frame_curr)
+            self.screened += 1
+            stats.count("frames_screened")
+            h, w = self._frame_size
+            return cv.resize(coarse, (w, h), interpolation=cv.INTER_NEAREST)
+
+        if not self._awake:
+            with stats.stage("replay"):
+                self.fine.initialize(self._frame_size, self._fps)
+                recent = list(self._recent)
+                for prev, curr in zip(recent[:-1], recent[1:]):
+                    self.fine.update_model(prev, curr)
+            self._recent.clear()
+            self._awake = True
+        with stats.stage("fine"):
+            return self.fine.update_model(frame_prev, frame_curr, stop_after)
+
+    def warm_up(self, frame):
+        self.coarse.warm_up(self._downscale(frame))
+        self._recent.append(frame)
+
+    #Only the coarse PCH is saved, the full resolution one starts over from 
+    #the frames given to `warm_up` after loading
+    def save_checkpoint(self, fn, **extra):
+        self.coarse.save_checkpoint(fn, **extra)
+
+    def load_checkpoint(self, fn):
+        self._awake = False
+        return self.coarse.load_checkpoint(fn)
+
+    def initialize(self, frame_size, fps):
+        h, w = frame_size
+        self._frame_size = frame_size
+        self._coarse_size = (h // self._scale, w // self._scale)
+        self._fps = fps
+        self._awake = False
+        self._recent = deque(maxlen=(self._replay or int(fps)) + 1)
+        self.screened = 0
+        self.coarse.initialize(self._coarse_size, fps)
@@ -5,16 +5,151 @@
 This script is demonstration of the ONC Oceans 2.0 sandbox.  The program will access video files from an underwater video camera and reduce the videos duration by roughly 50 percent to save on space and watch time. The videos are reduced based on "novelty" which is modelled using background subtraction and historical repetition.
 """
 
-from onc.onc import ONC
-
 import imageio
 import cv2 as cv
 import numpy as np
 import json 
 import shutil
 import sys
+import multiprocessing
+import traceback
+import os
+import glob
+
+from collections import deque
+from pch import PCH, PyramidPCH
+import utils
+from utils import stats
+import segments
+import novelty
+import sampling
+
+"""
+Decode the frames of the video in order from `start`.  A frame that can't be
+decoded ends the video since the decoder only moves forward.
+"""
+def readFrames(video, start=0):
+    frame_num = start
+    while True:
+        try:
+            frame = video.get_data(frame_num)
+        except IndexError:
+            return
+        except Exception:
+            print("Can't access frame #", frame_num, file=sys.stderr)
+            return
+        yield frame
+        frame_num += 1
+
+"""
+Decode the color frames [from_frame, to_frame) of the video.  The reader only
+seeks when it has to jump far ahead, so consecutive segments are read forward.
+"""
+def readColorFrames(video, from_frame, to_frame):
+    frames = []
+    for num in range(max(from_frame, 0), to_frame):
+        try:
+            frames.append(video.get_data(num))
+        except Exception:
+            print("Can't access frame #", num, file=sys.stderr)
+    return frames
+
+"""
+Decode the frames of the video already resized to `frame_size` and in
+grayscale so the analysis doesn't need to handle the full resolution color
+frames.  Uses imageio-ffmpeg to get gray frames from ffmpeg if it is installed,
+otherwise ffmpeg only does the resize.  Decoding starts at frame `start`.
+"""
+def readGrayFrames(video_fn, frame_size, start=0, fps=None):
+    h, w = frame_size
+    try:
+        import imageio_ffmpeg
+    except ImportError:
+        video = imageio.get_reader(video_fn, 'ffmpeg', size=(w, h))
+        for frame in readFrames(video, start):
+            yield cv.cvtColor(frame, cv.COLOR_RGB2GRAY)
+        video.close()
+        return
+
+    #ffmpeg seeks to the exact frame when decoding
+    seek = ["-ss", "{:.6f}".format(start / fps)] if start else []
+    frames = imageio_ffmpeg.read_frames(video_fn, pix_fmt="gray", bpp=1,
+                input_params=seek,
+                output_params=["-s", "{}x{}".format(w, h), "-sws_flags", "bilinear"])
+    next(frames) #meta data
+    for frame in frames:
+        yield np.frombuffer(frame, dtype=np.uint8).reshape(h, w)
+
+"""
+Resize a decoded color frame to the analysis size and grayscale it
+"""
+def toGray(frame_color, frame_size):
+    gray = cv.resize(frame_color, (frame_size[1],frame_size[0])) 
+    return cv.cvtColor(gray, cv.COLOR_RGB2GRAY) 
 
-from pch import PCH
+"""
+Create the novelty model, coarse to fine if `pyramid` is set
+"""
+def createModel(opts):
+    if opts['pyramid']:
+        return PyramidPCH(opts['pyramid'], opts['pyramidThreshold'], **opts["pch"])
+    return PCH(**opts["pch"])
+
+"""
+Analyse the sampled frames of [begin, stop) and return the novelty of each
+sampled frame as (frame number, new motion, old motion, histogram).  The
+frames before `start` only warm up the model (the GMM history and T matrix)
+and are not returned.  `begin` and `start` must be multiples of the sampling
+rate.
+"""
+def analyseShard(video_fn, opts, frame_size, fps, begin, start, stop=None):
+    video = imageio.get_reader(video_fn,  'ffmpeg')
+    pch = createModel(opts)
+    pch.initialize(frame_size, fps)
+
+    analysed = []
+    gray_prev = None
+    for frame_num in range(begin, stop or sys.maxsize, opts['samplingRate']):
+        try:
+            frame_color = video.get_data(frame_num)
+        except IndexError:
+            break
+        except Exception:
+            print("Can't access frame #", frame_num, file=sys.stderr)
+            continue
+
+        gray_curr = toGray(frame_color, frame_size)
+        if gray_prev is None:
+            gray_prev = gray_curr
+        result = pch.update_model(gray_prev, gray_curr)
+        gray_prev = gray_curr
+
+        if frame_num >= start:
+            grid = opts['indexGrid'] if opts['index'] else 0
+            analysed.append((frame_num,) + novelty.countEvents(result, grid))
+
+    video.close()
+    return analysed
+
+"""
+Split the video in `shards` parts, analyse them in parallel and return the
+novelty of the sampled frames like `analyseShard`.  Each shard starts `warmup`
+seconds early so its model has converged by the time its decisions count.
+"""
+def analyseShards(video_fn, opts, frame_size, fps, nframes, shards):
+    samplingRate = opts['samplingRate']
+    warmup = int(opts['warmup'] * fps) // samplingRate * samplingRate
+    length = -(-nframes // shards // samplingRate) * samplingRate
+
+    args = []
+    for i in range(shards):
+        start = i * length
+        stop = start + length if i < shards - 1 else None
+        args.append((video_fn, opts, frame_size, fps, max(start - warmup, 0), start, stop))
+
+    with multiprocessing.Pool(shards) as pool:
+        analysed = pool.starmap(analyseShard, args)
+    return [ row for shard in analysed for row in shard ]
 
 """
 Run through the video and only save frames that exhibit
@@ -26,65 +161,216 @@ def runVideo(video_fn, video_out_fn, opts, video_debug_fn=""):
     debug = opts['debug']
     print("INFO: Debug mode = {}".format(debug))
 
+    #Where the time goes, exported next to the summary at the end
+    stats.reset(enabled=bool(opts['stats']))
+    stats.count("bytes_read", os.path.getsize(video_fn))
+
     video = imageio.get_reader(video_fn,  'ffmpeg')
 
     #To speed up processing, we resize the video to smaller
     #dimensions
     frame_size = (608,800) 
     fps = video.get_meta_data()['fps']
-    nframes = video.get_meta_data()['nframes']
 
-    #We'll use the same frames per second as the input video
-    video_out = imageio.get_writer(video_out_fn, fps=fps)
+    #Long videos can be split in time and analysed in parallel, then only the
+    #writing is done here.  Pools can't be nested, so not inside a worker. 
+    shards = opts['shards']
+    if shards > 1 and multiprocessing.current_process().daemon:
+        print("INFO: Not sharding {}, already running in a worker".format(video_fn))
+        shards = 1
+    #The novelty of every analysed frame can be saved so the summary can be
+    #made again with other thresholds, see resummarize.py
+    samplingRate = opts['samplingRate']
+    index = None
+    if opts['index']:
+        index = novelty.IndexWriter(os.path.splitext(video_out_fn)[0] + ".index",
+                                    video_fn, fps, samplingRate)
 
-    if debug:
-        video_debug = imageio.get_writer(video_debug_fn, fps=fps)
+    kept = None
+    if shards > 1:
+        nframes = int(video.get_meta_data()['duration'] * fps)
+        analysed = analyseShards(video_fn, opts, frame_size, fps, nframes, shards)
+        kept = set(frame_num for frame_num, new_motion, _, _ in analysed 
+                   if new_motion > opts["sampleThreshold"])
+        if index is not None:
+            for row in analysed:
+                index.append(*row)
+        #There are no event maps to show
+        debug = False
+
+    #With the "copy" and "segments" outputs the kept frames aren't encoded,
+    #they become segments of the original video that are cut with a stream 
+    #copy or only written to a sidecar
+    output = opts['output']
+    encoding = output == "encode"
+    decisions = []
+    strides = []
+
+    #Which frames are analysed.  The shards already analysed every 
+    #`samplingRate`-th frame, so the sampling isn't adaptive then.
+    if opts['adaptiveSampling'] and kept is None:
+        sampler = sampling.Sampler(samplingRate, opts['sampleThreshold'],
+                                   opts['minStride'], opts['maxStride'],
+                                   opts['wakeThreshold'])
+    else:
+        sampler = sampling.Sampler(samplingRate, opts['sampleThreshold'])
 
     print(video._meta)
     
-    gray_curr = None
     gray_prev = None 
 
     #Create our novelty model
-    pch = PCH(**opts["pch"])
+    pch = createModel(opts)
     pch.initialize(frame_size, fps)
 
+    #Every `checkpointInterval` seconds of video the state is saved, so a run
+    #that was killed can resume from there.  The summary is then written in
+    #parts since an unfinished video can't be read, and joined at the end.
+    stem, extension = os.path.splitext(video_out_fn)
+    checkpoint_fn = stem + ".checkpoint.npz"
+    part_fn = lambda part: "{}.part{:03d}{}".format(stem, part, extension)
+    interval = int(opts['checkpointInterval'] * fps) if kept is None else 0
+    checkpoints = 0
+    resumed_at = -1
+
+    if interval and os.path.isfile(checkpoint_fn):
+        state = pch.load_checkpoint(checkpoint_fn)
+        resumed_at = int(state["frame_num"])
+        checkpoints = int(state["checkpoints"])
+        gray_prev = state["gray_prev"]
+        decisions = state["decisions"].tolist()
+        strides = state["strides"].tolist()
+        sampler.restore(state)
+        if index is not None:
+            index.extend({ name[len("index_"):] : column for name, column 
+                           in state.items() if name.startswith("index_") })
+        print("INFO: Resuming {} from frame #{}".format(video_fn, resumed_at))
+
+        #The GMM isn't in the checkpoint, so it sees the frames before again
+        warmup = int(opts['warmup'] * fps) // samplingRate * samplingRate
+        for frame_num in range(max(resumed_at - warmup, 0), resumed_at + 1, samplingRate):
+            pch.warm_up(toGray(video.get_data(frame_num), frame_size))
+
+    #We'll use the same frames per second as the input video
+    if encoding:
+        video_out = imageio.get_writer(part_fn(checkpoints) if interval else video_out_fn, 
+                                       fps=fps)
+
+    if debug:
+        video_debug = imageio.get_writer(video_debug_fn, fps=fps)
+
+    #Without the index or debug video only the keep/drop decision is needed, 
+    #so the tiled model can stop once it has found enough events
+    stop_after = None
+    if opts['earlyExit'] and index is None and not debug:
+        stop_after = opts['sampleThreshold']
+
     #Another time saving measure, we're only going to sample
-    #some of the videos for analysis
-    sampledFrames = np.arange(0,nframes, opts['samplingRate'])
+    #some of the videos for analysis.  The video is decoded only once, from
+    #start to end, and the frames skipped by the sampling are kept in a ring
+    #buffer so they can be written without decoding them again.
+    skipped = deque(maxlen=sampler.max_stride)
+
+    #With decoderScale ffmpeg gives us small gray frames to analyse and the 
+    #full color frames are only decoded for the parts of the video we keep
+    decoderScale = opts['decoderScale']
+    start = max(resumed_at, 0)
+    if decoderScale:
+        frames = readGrayFrames(video_fn, frame_size, start, fps)
+    else:
+        frames = readFrames(video, start)
+    frames = stats.timed(frames, "decode")
+
+    #Analyse a decoded frame and return what needs to be written for it
+    def analyse(frame_num, frame):
+        nonlocal gray_prev, checkpoints
+        stats.count("frames_decoded")
+        #Frames up to the checkpoint we resumed from are only kept for the 
+        #backfill, the sampler already points past it
+        if not sampler.due(frame_num, frame):
+            if encoding and not decoderScale:
+                skipped.append(frame)
+            return []
+
+        frame_color = frame
+        if decoderScale:
+            gray_curr = frame
+            frame_color = cv.cvtColor(gray_curr, cv.COLOR_GRAY2RGB)
+        elif kept is None:
+            with stats.stage("resize"):
+                gray_curr = toGray(frame_color, frame_size)
         
-    frame_color = video.get_data(0)
-    gray_prev = cv.resize(frame_color, (frame_size[1],frame_size[0])) 
-    gray_prev = cv.cvtColor(gray_prev, cv.COLOR_RGB2GRAY) 
-    
-    for frame_num in sampledFrames:
-        try:
-            frame_color = video.get_data(frame_num) 
-        except:
-            print("Can't access frame #", frame_num, file=sys.stderr)
-            continue
+        #The decision was already made when the video is sharded
+        if kept is not None:
+            keep = frame_num in kept
+            display_result = None
+        else:
+            if gray_prev is None:
+                gray_prev = gray_curr
 
-        gray_curr = cv.resize(frame_color, (frame_size[1],frame_size[0])) 
-        gray_curr = cv.cvtColor(gray_curr, cv.COLOR_RGB2GRAY) 
+            #Given the underwater is murky, we'll only consider high novel events (255). 
+            with stats.stage("analyse"):
+                result = pch.update_model(gray_prev, gray_curr, stop_after)
+                display_result = result.copy() if debug else None
+                new_motion, old_motion, histogram = novelty.countEvents(result, 
+                                                            opts['indexGrid'] if index else 0)
+            stats.count("frames_analysed")
+            if index is not None:
+                index.append(frame_num, new_motion, old_motion, histogram)
 
-        #Given the underwater is murky, we'll only consider high novel events (255). 
-        result = pch.update_model(gray_prev, gray_curr)
-        display_result = result.copy()
-        result[result < 255] = 0
-        new_motion = np.count_nonzero(result)
+            gray_prev = gray_curr
 
-        gray_prev = gray_curr
+            #To prevent noise, we'll use a threshold for the number of events. Since we always resize videos, we can use a set value
+            keep = new_motion > opts["sampleThreshold"]
+
+        #The frames since the analysed frame before this one
+        stride = sampler.since(frame_num)
+        sampler.update(frame_num, new_motion if kept is None else 0, keep, frame)
 
-        #To prevent noise, we'll use a threshold for the number of events. Since we always resize videos, we can use a set value
-        if new_motion > opts["sampleThreshold"]: 
-            #To prevent video "fast forwarding" we'll go back and write the frames that we skipped during sampling.  This adds a bit of time back but still better than not sampling.
-            from_frame = frame_num - opts["samplingRate"]
-            for num in np.arange(from_frame, frame_num):
-                video_out.append_data(video.get_data(num))
-            video_out.append_data(frame_color)
+        backfill = []
+        if keep:
+            decisions.append(frame_num)
+            strides.append(stride)
+        if keep and encoding: 
+            #To prevent video "fast forwarding" we'll go back and write the frames that we skipped during sampling.  These are still in memory (unless decoderScale is set) so this mostly costs the encoding.
+            if decoderScale:
+                backfill = range(frame_num - stride, frame_num + 1)
+            else:
+                backfill = list(skipped)[-stride:] + [frame_color]
+        if encoding and not decoderScale:
+            skipped.append(frame_color)
         
         if frame_num % int(fps)*5 == 0:
             print("- {} seconds done.".format(frame_num / fps))
+
+        #The state is saved now, but only used once the frames up to here are
+        #written (see encode)
+        checkpoint = 0
+        if interval and frame_num >= (checkpoints + 1) * interval:
+            checkpoints += 1
+            checkpoint = checkpoints
+            extra = { "index_" + name : column for name, column 
+                      in (index.columns().items() if index is not None else []) }
+            pch.save_checkpoint("{}.{}.next".format(checkpoint_fn, checkpoint), 
+                                frame_num=frame_num, 
+                                checkpoints=checkpoints,
+                                gray_prev=gray_curr, 
+                                decisions=np.array(decisions, dtype=np.int64),
+                                strides=np.array(strides, dtype=np.int64),
+                                **dict(extra, **sampler.state()))
+
+        return [(backfill, frame_color, display_result, checkpoint)]
+
+    #Write the kept frames and the debug video
+    def encode(backfill, frame_color, display_result, checkpoint=0):
+        nonlocal video_out
+        if decoderScale and len(backfill):
+            with stats.stage("decode"):
+                backfill = readColorFrames(video, backfill.start, backfill.stop)
+        with stats.stage("encode"):
+            for frame in backfill:
+                video_out.append_data(frame)
+        stats.count("frames_written", len(backfill))
        
         #Save debug video during debugging 
         if debug:
@@ -92,67 +378,174 @@ def runVideo(video_fn, video_out_fn, opts, video_debug_fn=""):
             display_result = np.hstack((cv.resize(frame_color, (frame_size[1],frame_size[0])), display_result))
             video_debug.append_data(display_result)
 
-    video_out.close()
+        #Start a new part of the summary before the checkpoint is used
+        if checkpoint:
+            if encoding:
+                video_out.close()
+                video_out = imageio.get_writer(part_fn(checkpoint), fps=fps)
+            os.replace("{}.{}.next".format(checkpoint_fn, checkpoint), checkpoint_fn)
+
+    #The decoding, analysis and encoding can run in their own threads since 
+    #ffmpeg and OpenCV do most of their work without holding the GIL
+    if kept is not None and not encoding:
+        #Nothing to decode, the shards already made the decisions
+        decisions = sorted(kept)
+        strides = [samplingRate] * len(decisions)
+    elif opts['pipeline']:
+        utilization = utils.pipeline([("decode", enumerate(frames, start)),
+                                      ("analyse", analyse),
+                                      ("encode", encode)], 
+                                     maxsize=samplingRate)
+        print("INFO: Stage utilization", 
+              ", ".join("{} {:.0%}".format(*u) for u in utilization.items()))
+    else:
+        for frame_num, frame in enumerate(frames, start):
+            for job in analyse(frame_num, frame):
+                encode(*job)
+
+    if encoding:
+        video_out.close()
+        if interval:
+            parts = [ part_fn(part) for part in range(checkpoints + 1) 
+                      if os.path.isfile(part_fn(part)) ]
+            if parts:
+                segments.concat([ (part, None) for part in parts ], video_out_fn)
+            for part in parts:
+                os.remove(part)
     video.close()
 
+    if index is not None:
+        index.close()
+
     if debug:
         video_debug.close()
- 
-    #To prevent any memory leaks
-    del pch
-
-#Load user defined options from a json file 
-print("INFO: Loading user settings from json file")
-with open("params.json", "r") as f:
-    params = json.load(f)
-
-    onc_    = params["onc"]
-    search_ = params["search"]
-    opts    = params["summarize"]
-    
-    print("INFO: Connecting to ONC Oceans 2.0")
-    onc = ONC(onc_["token"], 
-              onc_["production"],
-              onc_["showInfo"], 
-              onc_["outPath"])
-
-    #Replace this value(s) with the desired video feeds 
-    #you want to examine.
-    print("INFO: Performing data queries")
-    dps = onc.getDataProducts(filters={
-                'deviceCode'   : search_["deviceCode"], 
-                'locationCode' : search_["locationCode"], 
-                'extension'    : search_["extension"]})[0]
-    query = {
-        'dateFrom'          : search_["dateFrom"], 
-        'dateTo'            : search_["dateTo"], 
-        'dataProductCode'   : dps['dataProductCode'],
-        'extension'         : dps['extension'],
-        'deviceCode'        : search_["deviceCode"],
-    }
-
-    #We don't want to download at once in case we have a large amount of video files, so we just retrieve the url files
-    print("INFO: Retrieve the data product info")
-    orders = onc.orderDataProduct(
-                query, 
-                onc_["maxRetries"], 
-                onc_["downloadResultsOnly"], 
-                onc_["includeMetadataFile"])
-
-    toDownload = [ (order['url'], order['file']) for order in orders['downloadResults']]
-    for url,video_fn in toDownload:
-        result = onc.downloadFile(url)
-        print("{} downloaded: {}".format(video_fn, result['downloaded']))
-       
+
+    if not encoding:
+        kept_segments = segments.fromFrames(decisions, strides)
+        sidecar_fn = os.path.splitext(video_out_fn)[0]
+        segments.writeJSON(sidecar_fn + ".json", video_fn, kept_segments, fps)
+        print("INFO: {} segments kept".format(len(kept_segments)))
+
+        if output == "segments":
+            segments.writePlaylist(sidecar_fn + ".ffconcat", 
+                    [ (video_fn, (start / fps, end / fps)) for start, end in kept_segments ])
+        elif kept_segments:
+            segments.cut(video_fn, video_out_fn, kept_segments, fps, 
+                         opts['boundaryReencode'])
+
+    for fn in glob.glob(checkpoint_fn + "*"):
+        os.remove(fn)
+
+    if opts['stats']:
+        stats.export(stem + ".stats.json")
+
+"""
+Summarize a downloaded video and replace the original with the summary unless
+it is kept.  Returns the video file name and the error message if it failed,
+so a failed video doesn't stop the others.
+"""
+def summarizeVideo(video_fn, opts, extension):
+    try:
         print("{}: Reducing video to important events".format(video_fn))
-        video_out_fn = video_fn.replace("." + search_["extension"], "_summ." + search_["extension"])
-        video_debug_fn = video_fn.replace("." + search_["extension"], "_debug." + search_["extension"])
+        video_out_fn = video_fn.replace("." + extension, "_summ." + extension)
+        video_debug_fn = video_fn.replace("." + extension, "_debug." + extension)
         runVideo(video_fn, video_out_fn, opts, video_debug_fn )
        
         #Most of the video is not important, so we don't want to keep the original video to save space.
-        if not opts["keepOriginal"]:
-            shutil.move(video_out_fn, video_fn)
+        #The segments sidecar needs the original video though.
+        #When nothing is kept (with `copy`) there is no summary to replace it with.
+        if not opts["keepOriginal"] and opts["output"] != "segments":
+            if os.path.isfile(video_out_fn):
+                shutil.move(video_out_fn, video_fn)
+            else:
+                os.remove(video_fn)
             print("{}: Removing original file ".format(video_fn))
-        print("{}:  Finished.".format(video_fn))
+    except Exception as e:
+        traceback.print_exc()
+        return video_fn, "{}: {}".format(type(e).__name__, str(e).split("\n")[0])
+
+    print("{}:  Finished.".format(video_fn))
+    return video_fn, None
+
+if __name__ == "__main__":
+    from onc.onc import ONC
+
+    #Load user defined options from a json file 
+    print("INFO: Loading user settings from json file")
+    with open("params.json", "r") as f:
+        params = json.load(f)
+
+        onc_    = params["onc"]
+        search_ = params["search"]
+        opts    = params["summarize"]
+        
+        print("INFO: Connecting to ONC Oceans 2.0")
+        onc = ONC(onc_["token"], 
+                  onc_["production"],
+                  onc_["showInfo"], 
+                  onc_["outPath"])
+
+        #Replace this value(s) with the desired video feeds 
+        #you want to examine.
+        print("INFO: Performing data queries")
+        dps = onc.getDataProducts(filters={
+                    'deviceCode'   : search_["deviceCode"], 
+                    'locationCode' : search_["locationCode"], 
+                    'extension'    : search_["extension"]})[0]
+        query = {
+            'dateFrom'          : search_["dateFrom"], 
+            'dateTo'            : search_["dateTo"], 
+            'dataProductCode'   : dps['dataProductCode'],
+            'extension'         : dps['extension'],
+            'deviceCode'        : search_["deviceCode"],
+        }
+
+        #We don't want to download at once in case we have a large amount of video files, so we just retrieve the url files
+        print("INFO: Retrieve the data product info")
+        orders = onc.orderDataProduct(
+                    query, 
+                    onc_["maxRetries"], 
+                    onc_["downloadResultsOnly"], 
+                    onc_["includeMetadataFile"])
+
+        toDownload = [ (order['url'], order['file']) for order in orders['downloadResults']]
+
+        #Several videos can be summarized at the same time, each in its own 
+        #process, while the next ones are downloading
+        workers = opts["workers"]
+        pool = multiprocessing.Pool(workers) if workers > 1 else None
+
+        #The next videos are downloaded in the background while we process
+        #the current ones, within the disk budget
+        prefetcher = utils.Prefetcher(toDownload, 
+                                      lambda url, video_fn: onc.downloadFile(url),
+                                      opts["prefetch"] + workers - 1,
+                                      opts["diskBudget"] * 2**20)
+
+        results = []
+        for video_fn, result, error in prefetcher:
+            if error is not None:
+                results.append((video_fn, "Download failed: {}".format(error)))
+                prefetcher.done(video_fn)
+                continue
+            print("{} downloaded: {}".format(video_fn, result['downloaded']))
+
+            args = (video_fn, opts, search_["extension"])
+            if pool is None:
+                results.append(summarizeVideo(*args))
+                prefetcher.done(video_fn)
+            else:
+                results.append(pool.apply_async(summarizeVideo, args, 
+                                    callback=lambda result: prefetcher.done(result[0])))
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+            results = [ result if isinstance(result, tuple) else result.get() for result in results ]
+
+        failed = [ (video_fn, error) for video_fn, error in results if error ]
+        print("INFO: {} of {} videos summarized".format(len(results) - len(failed), len(results)))
+        for video_fn, error in failed:
+            print("ERROR: {}: {}".format(video_fn, error), file=sys.stderr)
 
-print("INFO: Script finished")
+    print("INFO: Script finished")
@@ -0,0 +1,47 @@
+#!/usr/env/python3
+"""
+
+Make a summary again from the novelty index saved by `reduce_script.py` (with
+`index` set in params.json) using another `sampleThreshold` and/or only every
+`stride`-th analysed frame.  The video is not analysed or decoded again, the
+summary is cut from the original video with a stream copy or only written as
+a segment list (see the `output` parameter).
+
+From the `summarize` folder:
+    python3 resummarize.py <video>_summ.index <video_out> [sampleThreshold] [stride] [output]
+"""
+
+import os
+import sys
+
+import novelty
+import segments
+
+def resummarize(index_dir, video_out_fn, sampleThreshold, stride=1, output="copy"):
+    meta, columns = novelty.loadIndex(index_dir)
+    kept = novelty.keptFrames(columns, sampleThreshold, stride)
+    strides = novelty.keptStrides(columns, sampleThreshold, meta["samplingRate"], stride)
+    kept_segments = segments.fromFrames(kept, strides)
+
+    stem = os.path.splitext(video_out_fn)[0]
+    segments.writeJSON(stem + ".json", meta["video"], kept_segments, meta["fps"])
+    if output == "segments":
+        segments.writePlaylist(stem + ".ffconcat", 
+                [ (meta["video"], (start / meta["fps"], end / meta["fps"])) 
+                  for start, end in kept_segments ])
+    elif kept_segments:
+        segments.cut(meta["video"], video_out_fn, kept_segments, meta["fps"])
+    return kept_segments
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print(__doc__)
+        sys.exit(1)
+
+    index_dir, video_out_fn = sys.argv[1:3]
+    sampleThreshold = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+    stride = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+    output = sys.argv[5] if len(sys.argv) > 5 else "copy"
+
+    kept_segments = resummarize(index_dir, video_out_fn, sampleThreshold, stride, output)
+    print("INFO: {} segments kept".format(len(kept_segments)))
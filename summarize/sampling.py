@@ -0,0 +1,82 @@
+"""
+Decides which frames of a video are analysed.  By default every
+`samplingRate`-th frame is.  With adaptive sampling the stride between
+analysed frames grows during quiet stretches (up to `maxStride`) and shrinks
+(down to `minStride`) when the number of events gets close to the
+`sampleThreshold` or the keep/drop decision changes, so the boundaries of the
+kept segments are found precisely.  So a long stride doesn't miss a short
+event, every `samplingRate`-th frame in between is still compared to the last
+analysed frame on a thumbnail, and analysed if it changed by more than
+`wakeThreshold` gray levels.
+"""
+
+import cv2 as cv
+import numpy as np
+
+class Sampler(object):
+    def __init__(self, samplingRate, sampleThreshold, minStride=None, maxStride=None,
+                 wakeThreshold=3.):
+        self._samplingRate = samplingRate
+        self._threshold = sampleThreshold
+        self._minStride = minStride or samplingRate
+        self._maxStride = maxStride or samplingRate
+        self._wakeThreshold = wakeThreshold
+        self.stride = samplingRate
+        self.next_frame = 0
+        self._last_frame = -samplingRate
+        self._keep = False
+        self._thumbnail = None
+
+    @property
+    def adaptive(self):
+        return self._minStride != self._maxStride
+
+    #The most frames there can be between two analysed frames
+    @property
+    def max_stride(self):
+        return max(self._maxStride, self._samplingRate)
+
+    #The number of frames since the analysed frame before `frame_num`
+    def since(self, frame_num):
+        return frame_num - self._last_frame
+
+    def _thumb(self, frame):
+        return cv.resize(frame, (32, 24), interpolation=cv.INTER_AREA).astype(np.int16)
+
+    def due(self, frame_num, frame=None):
+        if frame_num == self.next_frame:
+            return True
+        if not self.adaptive or frame is None or self._thumbnail is None \
+           or self.since(frame_num) % self._samplingRate:
+            return False
+        change = np.abs(self._thumb(frame) - self._thumbnail).mean()
+        return change > self._wakeThreshold
+
+    #Choose the next frame to analyse from the novelty of the analysed frame
+    def update(self, frame_num, new_motion, keep, frame=None):
+        if self.adaptive:
+            close = self._threshold / 2. <= new_motion <= self._threshold * 2.
+            if keep != self._keep or close:
+                self.stride = self._minStride
+            else:
+                #While frames are kept, don't sample less than usual
+                self.stride = min(self.stride * 2,
+                                  self._samplingRate if keep else self._maxStride)
+            self._keep = keep
+            if frame is not None:
+                self._thumbnail = self._thumb(frame)
+        self._last_frame = frame_num
+        self.next_frame = frame_num + self.stride
+
+    #The state to save in a checkpoint, and to restore it
+    def state(self):
+        return { "sampler_stride" : self.stride,
+                 "sampler_next"   : self.next_frame,
+                 "sampler_last"   : self._last_frame,
+                 "sampler_keep"   : self._keep }
+
+    def restore(self, state):
+        self.stride = int(state["sampler_stride"])
+        self.next_frame = int(state["sampler_next"])
+        self._last_frame = int(state["sampler_last"])
+        self._keep = bool(state["sampler_keep"])
@@ -0,0 +1,192 @@
+"""
+Helpers to turn the frames kept by the summarization into time segments of the
+original video.  The segments can be written as a sidecar (JSON and an ffmpeg
+concat playlist) so the summary can be played without writing a new video, or
+cut out of the original with a stream copy instead of encoding every frame.
+"""
+
+import bisect
+import imageio
+import json
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+
+"""
+Find the ffmpeg executable used by imageio
+"""
+def ffmpegExe():
+    try:
+        import imageio_ffmpeg
+    except ImportError:
+        return imageio.plugins.ffmpeg.get_exe()
+    return imageio_ffmpeg.get_ffmpeg_exe()
+
+"""
+Merge the kept sampled frames into [start, end) frame segments.  A kept
+sampled frame also keeps the `samplingRate` frames before it, like the
+frames written by `runVideo`.  With adaptive sampling, `samplingRate` is a
+list with the number of frames since the analysed frame before each kept frame.
+"""
+def fromFrames(kept, samplingRate):
+    if isinstance(samplingRate, int):
+        samplingRate = [samplingRate] * len(kept)
+    segments = []
+    for frame_num, stride in sorted(zip(kept, samplingRate)):
+        start, end = max(frame_num - stride, 0), frame_num + 1
+        if segments and start <= segments[-1][1]:
+            segments[-1][1] = max(segments[-1][1], end)
+        else:
+            segments.append([start, end])
+    return [ tuple(segment) for segment in segments ]
+
+"""
+Write the segments (in frames and seconds of the original video) to a JSON file
+"""
+def writeJSON(json_fn, video_fn, segments, fps):
+    with open(json_fn, "w") as f:
+        json.dump({
+            "video"    : os.path.basename(video_fn),
+            "fps"      : fps,
+            "segments" : [ { "start"     : start,
+                             "end"       : end,
+                             "startTime" : start / fps,
+                             "endTime"   : end / fps } for start, end in segments ]
+        }, f, indent=4)
+
+"""
+Write an ffconcat playlist that plays the segments of the video(s).  Each entry
+is a file name and the (inpoint, outpoint) in seconds, None for the whole file.
+Files are relative to the playlist, so it can be played with
+`ffplay -f concat -i <playlist>` from anywhere.
+"""
+def writePlaylist(playlist_fn, entries):
+    playlist_dir = os.path.dirname(os.path.abspath(playlist_fn))
+    with open(playlist_fn, "w") as f:
+        f.write("ffconcat version 1.0\n")
+        for fn, points in entries:
+            fn = os.path.relpath(os.path.abspath(fn), playlist_dir)
+            f.write("file '{}'\n".format(fn.replace("'", "'\\''")))
+            if points is not None:
+                f.write("inpoint {:.6f}\n".format(points[0]))
+                f.write("outpoint {:.6f}\n".format(points[1]))
+
+"""
+Return the times (in seconds) of the keyframes of the video.  Only the
+keyframes are decoded.
+"""
+def keyframes(video_fn):
+    cmd = [ffmpegExe(), "-hide_banner", "-skip_frame", "nokey", "-i", video_fn,
+           "-an", "-vf", "showinfo", "-f", "null", "-"]
+    log = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                         universal_newlines=True, check=True).stderr
+    return [ float(t) for t in re.findall(r"pts_time:\s*([-0-9.]+)", log) ]
+
+"""
+Split the video at its keyframes into one file per group of pictures (GOP) in
+`out_dir`, with a stream copy.  A GOP is cut where its keyframe starts in
+decoding order, so unlike the in and out points of a playlist, no frame of the
+next GOP leaks in with B-frames.  Returns the file names, in order.
+"""
+def splitGOPs(video_fn, keys, fps, out_dir):
+    ext = os.path.splitext(video_fn)[1]
+    pattern = os.path.join(out_dir, "gop%06d" + ext)
+    cmd = [ffmpegExe(), "-hide_banner", "-loglevel", "error", "-i", video_fn,
+           "-map", "0:v", "-map", "0:a?", "-c", "copy", "-f", "segment", 
+           "-reset_timestamps", "1"]
+    if len(keys) > 1:
+        #A little before each keyframe, the split is at the next keyframe
+        cmd += ["-segment_times", ",".join("{:.6f}".format(t - 0.25 / fps) for t in keys[1:])]
+    subprocess.run(cmd + [pattern], check=True)
+    return [ pattern % i for i in range(len(keys)) ]
+
+"""
+How long (in seconds) the first packet of the video is decoded before it is
+shown, 0 without B-frames
+"""
+def decodeDelay(video_fn):
+    log = subprocess.run([ffmpegExe(), "-hide_banner", "-loglevel", "error", 
+                          "-i", video_fn, "-map", "0:v:0", "-c", "copy", 
+                          "-frames:v", "1", "-f", "framemd5", "-"],
+                         stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+    num, den = re.search(r"#tb 0: (\d+)/(\d+)", log).groups()
+    dts, pts = re.search(r"^0,\s*(-?\d+),\s*(-?\d+),", log, re.M).groups()
+    return (int(pts) - int(dts)) * int(num) / int(den)
+
+"""
+Encode the frames [start, end) of the video (with x264) to `out_fn`, without
+B-frames.  The decoding times are moved `delay` seconds earlier, as in the
+copied GOPs, so that they keep increasing where the two are joined.
+"""
+def encodeFrames(video_fn, out_fn, start, end, fps, delay=0):
+    subprocess.run([ffmpegExe(), "-hide_banner", "-loglevel", "error",
+                    "-ss", "{:.6f}".format(start / fps), "-i", video_fn,
+                    "-frames:v", str(end - start), "-an", "-c:v", "libx264", "-bf", "0",
+                    "-pix_fmt", "yuv420p", "-r", str(fps), 
+                    "-bsf:v", "setts=dts=DTS-round({:.6f}/TB)".format(delay), out_fn], check=True)
+
+"""
+Cut the segments out of the video and join them in `video_out_fn` using a
+stream copy of whole GOPs, so nothing is decoded or encoded.  Each segment
+starts at the keyframe before it and ends at the keyframe after it.  With 
+`reencode`, the frames from the start of a segment to the next keyframe and
+from the last keyframe to the end of the segment are encoded (with x264) and
+only the whole GOPs in between are copied, which makes the cuts exact.
+"""
+def cut(video_fn, video_out_fn, segments, fps, reencode=False):
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(video_out_fn)))
+    try:
+        keys = keyframes(video_fn)
+        key_frames = [ int(round((t - keys[0]) * fps)) for t in keys ]
+        gops = splitGOPs(video_fn, keys, fps, tmp_dir)
+        delay = decodeDelay(video_fn) if reencode else 0
+
+        entries, copied = [], 0
+        for i, (start, end) in enumerate(segments):
+            if not reencode:
+                #Segments close together can share a GOP, it is copied once
+                first = max(bisect.bisect_right(key_frames, start) - 1, copied)
+                last = bisect.bisect_left(key_frames, end)
+                entries.extend((gop, None) for gop in gops[first:last])
+                copied = max(copied, last)
+                continue
+
+            #The keyframes in [start, end], the GOPs between them are copied
+            first = bisect.bisect_left(key_frames, start)
+            last = bisect.bisect_right(key_frames, end) - 1
+            if first > last:
+                parts = [ (start, end) ]
+            else:
+                parts = [ (start, key_frames[first]) ] + gops[first:last] + \
+                        [ (key_frames[last], end) ]
+            for j, part in enumerate(parts):
+                if not isinstance(part, tuple):
+                    entries.append((part, None))
+                elif part[1] > part[0]:
+                    part_fn = os.path.join(tmp_dir, "part{}_{}.mp4".format(i, j))
+                    encodeFrames(video_fn, part_fn, part[0], part[1], fps, delay)
+                    entries.append((part_fn, None))
+
+        concat(entries, video_out_fn, audio=not reencode)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+"""
+Join the playlist `entries` (see `writePlaylist`) in `video_out_fn` with a
+stream copy
+"""
+def concat(entries, video_out_fn, audio=True):
+    playlist_fd, playlist_fn = tempfile.mkstemp(suffix=".ffconcat", 
+                                    dir=os.path.dirname(os.path.abspath(video_out_fn)))
+    os.close(playlist_fd)
+    try:
+        writePlaylist(playlist_fn, entries)
+        cmd = [ffmpegExe(), "-hide_banner", "-loglevel", "error", "-y",
+               "-f", "concat", "-safe", "0", "-i", playlist_fn, "-c", "copy"]
+        if not audio:
+            cmd.append("-an")
+        subprocess.run(cmd + [video_out_fn], check=True)
+    finally:
+        os.remove(playlist_fn)
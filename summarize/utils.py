@@ -1,9 +1,19 @@
 import time
+import threading
+import queue
+import os
+import math
+import json
+
 class Timer(object):
-    def __init__(self, verbose=False):
+    def __init__(self, verbose=False, name=None, stats=None):
         self.verbose = verbose
+        self.name = name
+        self.stats = stats
 
     def __enter__(self):
+        if self.stats is not None:
+            self.stats._push(self.name)
         self.start = time.time()
         return self
 
@@ -11,6 +21,255 @@ class Timer(object):
         self.end = time.time()
         self.secs = self.end - self.start
         self.msecs = self.secs * 1000  # millisecs
+        if self.stats is not None:
+            self.stats._pop(self.secs)
         if self.verbose:
             print('Runtime: %f mins (%f secs)' % ((self.secs / 60.), self.secs))
 
+class _NoTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+_NO_TIMER = _NoTimer()
+
+"""
+Collects where the time of a run goes: the time spent in named stages, which
+can be nested ("analyse/bg_model"), a histogram of how long each stage took,
+and counters.  While it is disabled `stage` only returns a shared object that
+does nothing, so the instrumented code costs next to nothing.  Every thread 
+has its own nesting of stages.
+
+    with stats.stage("decode"):
+        ...
+    stats.count("frames_read")
+"""
+class Stats(object):
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def reset(self, enabled=None):
+        if enabled is not None:
+            self.enabled = enabled
+        self._stages = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._start = time.time()
+
+    def stage(self, name):
+        if not self.enabled:
+            return _NO_TIMER
+        return Timer(name=name, stats=self)
+
+    #Time every item taken from `iterable` as the stage `name`
+    def timed(self, iterable, name):
+        if not self.enabled:
+            return iterable
+        return self._timed(iter(iterable), name)
+
+    def _timed(self, iterator, name):
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def count(self, name, n=1):
+        if self.enabled:
+            with self._lock:
+                self._counters[name] = self._counters.get(name, 0) + n
+
+    def _push(self, name):
+        path = getattr(self._local, "path", ())
+        self._local.path = path + (name,)
+
+    def _pop(self, secs):
+        path = self._local.path
+        self._local.path = path[:-1]
+        #Histogram buckets are powers of two of milliseconds
+        bucket = 2. ** max(math.ceil(math.log2(max(secs * 1000, 1e-3))), -4)
+        with self._lock:
+            stage = self._stages.setdefault("/".join(path), 
+                                            { "calls" : 0, "secs" : 0., "histogram_ms" : {} })
+            stage["calls"] += 1
+            stage["secs"] += secs
+            stage["histogram_ms"][bucket] = stage["histogram_ms"].get(bucket, 0) + 1
+
+    #The stages (sorted by name, so nested stages follow their parent), the 
+    #counters and the seconds since the reset
+    def report(self):
+        with self._lock:
+            stages = {}
+            for path in sorted(self._stages):
+                stage = dict(self._stages[path])
+                stage["histogram_ms"] = { "{:g}".format(bucket) : n for bucket, n 
+                                          in sorted(stage["histogram_ms"].items()) }
+                stages[path] = stage
+            return { "secs"     : time.time() - self._start,
+                     "stages"   : stages,
+                     "counters" : dict(self._counters) }
+
+    def export(self, json_fn):
+        with open(json_fn, "w") as f:
+            json.dump(self.report(), f, indent=4)
+
+#The stats of this process, disabled until `stats.reset(enabled=True)`
+stats = Stats()
+
+"""
+Run `fn(*args)` in a child process and return its result and the peak
+resident memory of the child in MB, so every run is measured on its own.
+Unix only.
+"""
+def run_isolated(fn, *args):
+    import multiprocessing
+    import resource
+    import sys
+
+    def child(conn):
+        result = fn(*args)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        #Linux gives kB, macOS bytes
+        conn.send((result, peak / (1024. ** 2 if sys.platform == "darwin" else 1024.)))
+        conn.close()
+
+    context = multiprocessing.get_context("fork")
+    parent_conn, child_conn = context.Pipe(duplex=False)
+    process = context.Process(target=child, args=(child_conn,))
+    process.start()
+    child_conn.close()
+    try:
+        result = parent_conn.recv()
+    except EOFError:
+        raise RuntimeError("{} failed in the child process".format(fn.__name__))
+    finally:
+        process.join()
+    return result
+
+_END = object()
+
+"""
+Run items through a chain of stages, each stage in its own thread and connected
+by queues of at most `maxsize` items so a slow stage holds back the ones before
+it.  The first stage is an iterable of items, every other stage is a function
+called with each item (a tuple) that returns a list of items for the next stage.
+Items keep their order.  Returns the fraction of time each stage was busy.
+"""
+def pipeline(stages, maxsize=16):
+    names = [name for name, _ in stages]
+    queues = [queue.Queue(maxsize) for _ in stages[1:]]
+    busy = dict.fromkeys(names, 0.)
+    errors = []
+
+    def decode(name, source):
+        source = iter(source)
+        try:
+            while not errors:
+                start = time.time()
+                try:
+                    item = next(source)
+                except StopIteration:
+                    break
+                finally:
+                    busy[name] += time.time() - start
+                queues[0].put(item)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            queues[0].put(_END)
+
+    def process(name, fn, inbox, outbox):
+        for item in iter(inbox.get, _END):
+            #After an error, keep emptying the queue so no stage stays blocked 
+            if errors:
+                continue
+            start = time.time()
+            try:
+                results = fn(*item)
+            except Exception as e:
+                errors.append(e)
+                continue
+            finally:
+                busy[name] += time.time() - start
+            if outbox is not None:
+                for result in results:
+                    outbox.put(result)
+        if outbox is not None:
+            outbox.put(_END)
+
+    threads = [threading.Thread(target=decode, args=stages[0])]
+    for i, (name, fn) in enumerate(stages[1:]):
+        outbox = queues[i+1] if i+1 < len(queues) else None
+        threads.append(threading.Thread(target=process, 
+                                        args=(name, fn, queues[i], outbox)))
+
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    secs = time.time() - start
+
+    if errors:
+        raise errors[0]
+    return { name : busy[name] / secs for name in names }
+
+"""
+Download files in a background thread so the next ones are ready while the
+current one is processed.  At most `prefetch` files wait to be processed, and
+no new download starts while the files not done yet take more than `budget`
+bytes of disk (0 for no limit).  Iterating gives `(file, result, error)` in
+order, and `done(file)` must be called once a file has been processed.
+"""
+class Prefetcher(object):
+    def __init__(self, downloads, download, prefetch=2, budget=0):
+        self._downloads = list(downloads)
+        self._download  = download
+        self._prefetch  = prefetch
+        self._budget    = budget
+
+        self._pending   = {}  #file -> bytes on disk
+        self._ready     = queue.Queue()
+        self._cond      = threading.Condition()
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _can_download(self):
+        if not self._pending:
+            return True
+        if len(self._pending) > self._prefetch:
+            return False
+        return not self._budget or sum(self._pending.values()) < self._budget
+
+    def _run(self):
+        for url, fn in self._downloads:
+            with self._cond:
+                self._cond.wait_for(self._can_download)
+                self._pending[fn] = 0
+
+            result, error = None, None
+            try:
+                result = self._download(url, fn)
+            except Exception as e:
+                error = e
+
+            with self._cond:
+                if fn in self._pending and os.path.isfile(fn):
+                    self._pending[fn] = os.path.getsize(fn)
+            self._ready.put((fn, result, error))
+        self._ready.put(_END)
+
+    def __iter__(self):
+        return iter(self._ready.get, _END)
+
+    def done(self, fn):
+        with self._cond:
+            self._pending.pop(fn, None)
+            self._cond.notify_all()